@@ -1,15 +1,18 @@
-import math
-
 import numpy as np
+import scipy.sparse as sp
 import sklearn.cluster as cluster
+import sklearn.metrics as metrics
+import sklearn.preprocessing as preprocessing
+from sklearn.utils import check_random_state
 
 import mlcv.input_output as io
+import mlcv.pyramid as pyramid
 import mlcv.settings as settings
 
 
 def create_codebook(X, codebook_name=None, k_means_init='random'):
     k = settings.codebook_size
-    batch_size = 20 * k if X.shape[0] > 20 * k else X.shape[0] / 10
+    batch_size = 20 * k if X.shape[0] > 20 * k else max(X.shape[0] // 10, 1)
     codebook = cluster.MiniBatchKMeans(n_clusters=k, verbose=False, batch_size=batch_size, compute_labels=False,
                                        reassignment_ratio=10 ** -4, init=k_means_init)
 
@@ -27,6 +30,282 @@ def create_codebook(X, codebook_name=None, k_means_init='random'):
     return codebook
 
 
+def _grow_centroids(codebook, k, X, growth, split_epsilon, random_state):
+    centers = codebook.cluster_centers_
+    if X.shape[0] < k:
+        raise ValueError('Cannot grow a codebook to {} centroids from {} descriptors'.format(k, X.shape[0]))
+    # The sample is sized on the new number of centroids, from which the new ones are drawn by the warm start
+    sample = X[random_state.choice(X.shape[0], min(X.shape[0], 50 * k), replace=False)]
+
+    if growth == 'split':
+        # LBG-style growth: split the most populated clusters in two slightly perturbed copies
+        data_std = np.std(sample, axis=0)
+        while centers.shape[0] < k:
+            n_splits = min(k - centers.shape[0], centers.shape[0])
+            assignments = metrics.pairwise_distances_argmin(sample, centers)
+            counts = np.bincount(assignments, minlength=centers.shape[0])
+            split = np.argsort(-counts, kind='mergesort')[:n_splits]
+            delta = split_epsilon * data_std * random_state.randn(n_splits, centers.shape[1])
+            centers = np.vstack((centers, centers[split] + delta))
+            centers[split] -= delta
+    elif growth == 'warm_start':
+        # Keep the previous centroids and add new ones with k-means++ sampling on the distance to them
+        n_new = k - centers.shape[0]
+        sq_distances = np.min(codebook.transform(sample), axis=1) ** 2
+        candidates = np.flatnonzero(sq_distances > 0)
+        if candidates.shape[0] >= n_new:
+            new_centers = random_state.choice(candidates, n_new, replace=False,
+                                              p=sq_distances[candidates] / np.sum(sq_distances[candidates]))
+        else:
+            # Fewer samples away from the previous centroids than new centroids: all of them are taken, and the
+            # rest are drawn uniformly among the samples on the previous centroids
+            others = np.flatnonzero(sq_distances == 0)
+            new_centers = np.concatenate((candidates, random_state.choice(others, n_new - candidates.shape[0],
+                                                                          replace=False)))
+        centers = np.vstack((centers, sample[new_centers]))
+    else:
+        raise ValueError('Unknown codebook growth method: {}'.format(growth))
+
+    return centers
+
+
+def create_codebooks(X, codebook_sizes, codebook_name=None, growth='split', k_means_init='random',
+                     refine_iter=1, split_epsilon=0.05, random_state=None):
+    """
+    Trains a family of nested codebooks of increasing size in a single job, for codebook-size sweeps.
+
+    Only the smallest codebook is trained from scratch. Each of the following ones is initialised from the
+    centroids of the previous size, either by splitting the most populated clusters (LBG-style growth) or by
+    keeping them and adding new centroids with k-means++ sampling (warm start), and then refined with a few
+    MiniBatchKMeans epochs.
+
+    :param X: Descriptors matrix with dimensions (n_descriptors, n_features)
+    :type X: numpy.ndarray
+    :param codebook_sizes: Sizes of the codebooks to train
+    :type codebook_sizes: list
+    :param codebook_name: Format string with the name of each codebook, e.g. 'codebook_{}_dense'. Previously stored
+                          codebooks are loaded and used as starting point for the following sizes
+    :type codebook_name: basestring
+    :param growth: Method used to grow a codebook from the previous one: 'split' or 'warm_start'
+    :type growth: basestring
+    :param k_means_init: Initialisation method of the smallest codebook
+    :type k_means_init: basestring
+    :param refine_iter: Maximum number of epochs used to refine each grown codebook
+    :type refine_iter: int
+    :param split_epsilon: Perturbation applied to split centroids, relative to the standard deviation of the data
+    :type split_epsilon: float
+    :param random_state: Seed or random state used for the sampling and the clustering
+    :type random_state: int, numpy.random.RandomState
+
+    :return: Dictionary with the codebook of each size
+    :rtype: dict
+    """
+    random_state = check_random_state(random_state)
+    codebooks = {}
+    previous = None
+
+    for k in sorted(set(codebook_sizes)):
+        name = codebook_name.format(k) if codebook_name is not None else None
+        codebook = None
+        if name is not None:
+            # Try to load a previously trained codebook
+            try:
+                codebook = io.load_object(name)
+            except (IOError, EOFError):
+                pass
+
+        if codebook is None:
+            batch_size = 20 * k if X.shape[0] > 20 * k else max(X.shape[0] // 10, 1)
+            if previous is None:
+                codebook = cluster.MiniBatchKMeans(n_clusters=k, verbose=False, batch_size=batch_size,
+                                                   compute_labels=False, reassignment_ratio=10 ** -4,
+                                                   init=k_means_init, random_state=random_state)
+            else:
+                init = _grow_centroids(previous, k, X, growth, split_epsilon, random_state)
+                codebook = cluster.MiniBatchKMeans(n_clusters=k, verbose=False, batch_size=batch_size,
+                                                   compute_labels=False, reassignment_ratio=10 ** -4, init=init,
+                                                   n_init=1, max_iter=refine_iter, random_state=random_state)
+            codebook.fit(X)
+            if name is not None:
+                # Store the model with the provided name
+                io.save_object(codebook, name)
+
+        codebooks[k] = codebook
+        previous = codebook
+
+    return codebooks
+
+
+def iterate_image_descriptors(X, descriptors_indices):
+    """
+    Yields the descriptors of each image of an in-memory descriptors matrix, in image order.
+
+    :param X: Descriptors matrix with dimensions (n_descriptors, n_features)
+    :type X: numpy.ndarray
+    :param descriptors_indices: Image index of each descriptor
+    :type descriptors_indices: numpy.ndarray
+    """
+    for i in range(0, descriptors_indices.max() + 1):
+        yield X[descriptors_indices == i]
+
+
+def iterate_descriptor_files(filenames, mmap_mode='r'):
+    """
+    Yields the descriptors stored in a list of .npy files (one file per image) without loading them all in memory.
+
+    :param filenames: Paths to the .npy files, each one with dimensions (n_descriptors, n_features)
+    :type filenames: list
+    :param mmap_mode: Memory-map mode used to open each file
+    :type mmap_mode: basestring
+    """
+    for filename in filenames:
+        yield np.load(filename, mmap_mode=mmap_mode)
+
+
+def _descriptor_chunks(descriptors):
+    # The descriptors are traversed more than once, so one-shot iterators are not accepted
+    if callable(descriptors):
+        return iter(descriptors())
+    if iter(descriptors) is descriptors:
+        raise ValueError('Descriptor chunks must be a sequence or a callable returning a new iterator, '
+                         'a one-shot iterator cannot be traversed more than once')
+    return iter(descriptors)
+
+
+def _cap_descriptors(chunk, max_descriptors, random_state):
+    if max_descriptors is None or chunk.shape[0] <= max_descriptors:
+        return np.asarray(chunk)
+    selection = np.sort(random_state.choice(chunk.shape[0], max_descriptors, replace=False))
+    return np.asarray(chunk[selection])
+
+
+def reservoir_sample(descriptors, sample_size, max_descriptors_per_image=None, random_state=None):
+    """
+    Draws a uniform sample of descriptors across all the images with a single pass over the descriptor chunks
+    (reservoir sampling), so the whole set never has to be held in memory.
+
+    :param descriptors: Sequence of descriptor chunks (one per image) or callable returning an iterator over them
+    :type descriptors: list, callable
+    :param sample_size: Number of descriptors in the sample
+    :type sample_size: int
+    :param max_descriptors_per_image: Maximum number of descriptors randomly taken from each image
+    :type max_descriptors_per_image: int
+    :param random_state: Seed or random state used for the sampling
+    :type random_state: int, numpy.random.RandomState
+
+    :return: Sample with dimensions (min(sample_size, n_descriptors), n_features)
+    :rtype: numpy.ndarray
+    """
+    random_state = check_random_state(random_state)
+    reservoir = None
+    n_seen = 0
+
+    for chunk in _descriptor_chunks(descriptors):
+        chunk = _cap_descriptors(chunk, max_descriptors_per_image, random_state)
+        if chunk.shape[0] == 0:
+            continue
+        if reservoir is None:
+            reservoir = np.empty((sample_size, chunk.shape[1]), dtype=chunk.dtype)
+
+        # Fill the free slots of the reservoir first
+        n_free = max(sample_size - n_seen, 0)
+        n_fill = min(n_free, chunk.shape[0])
+        reservoir[n_seen:n_seen + n_fill] = chunk[:n_fill]
+
+        # Replace random slots with the probability of keeping each of the remaining descriptors
+        remaining = chunk[n_fill:]
+        if remaining.shape[0] > 0:
+            positions = n_seen + n_fill + np.arange(remaining.shape[0])
+            slots = np.floor(random_state.random_sample(remaining.shape[0]) * (positions + 1)).astype(np.int64)
+            keep = slots < sample_size
+            reservoir[slots[keep]] = remaining[keep]
+
+        n_seen += chunk.shape[0]
+
+    if reservoir is None:
+        raise ValueError('No descriptors were found to sample from')
+
+    return reservoir[:min(n_seen, sample_size)]
+
+
+def create_codebook_streaming(descriptors, codebook_name=None, k_means_init='random', max_descriptors_per_image=None,
+                              reservoir_size=None, n_passes=1, random_state=None):
+    """
+    Trains a codebook on descriptor chunks read one at a time (from disk or generated on the fly), so that the
+    vocabulary can be learnt on the whole descriptor set without concatenating it in memory.
+
+    The centroids are initialised on a reservoir sample drawn across all the images, and then refined with
+    MiniBatchKMeans.partial_fit over the stream of chunks.
+
+    :param descriptors: Sequence of descriptor chunks (one per image) or callable returning an iterator over them,
+                        e.g. ``lambda: iterate_descriptor_files(filenames)``
+    :type descriptors: list, callable
+    :param codebook_name: Name used to load or store the codebook
+    :type codebook_name: basestring
+    :param k_means_init: Initialisation method applied on the reservoir sample
+    :type k_means_init: basestring
+    :param max_descriptors_per_image: Maximum number of descriptors randomly taken from each image
+    :type max_descriptors_per_image: int
+    :param reservoir_size: Number of descriptors in the initialisation sample (3 mini-batches by default)
+    :type reservoir_size: int
+    :param n_passes: Number of passes over the descriptor chunks
+    :type n_passes: int
+    :param random_state: Seed or random state used for the sampling and the clustering
+    :type random_state: int, numpy.random.RandomState
+
+    :return: The trained codebook
+    :rtype: sklearn.cluster.MiniBatchKMeans
+    """
+    if codebook_name is not None:
+        # Try to load a previously trained codebook
+        try:
+            return io.load_object(codebook_name)
+        except (IOError, EOFError):
+            pass
+
+    k = settings.codebook_size
+    batch_size = 20 * k
+    if reservoir_size is None:
+        reservoir_size = 3 * batch_size
+    random_state = check_random_state(random_state)
+
+    # Initialise the centroids on a uniform sample of all the descriptors
+    sample = reservoir_sample(descriptors, reservoir_size, max_descriptors_per_image=max_descriptors_per_image,
+                              random_state=random_state)
+    init_codebook = cluster.MiniBatchKMeans(n_clusters=k, verbose=False, batch_size=min(batch_size, sample.shape[0]),
+                                            compute_labels=False, reassignment_ratio=10 ** -4, init=k_means_init,
+                                            random_state=random_state)
+    init_codebook.fit(sample)
+    del sample
+
+    codebook = cluster.MiniBatchKMeans(n_clusters=k, verbose=False, batch_size=batch_size, compute_labels=False,
+                                       reassignment_ratio=10 ** -4, init=init_codebook.cluster_centers_, n_init=1,
+                                       random_state=random_state)
+
+    for _ in range(n_passes):
+        pending = []
+        n_pending = 0
+        for chunk in _descriptor_chunks(descriptors):
+            chunk = _cap_descriptors(chunk, max_descriptors_per_image, random_state)
+            pending.append(chunk)
+            n_pending += chunk.shape[0]
+            if n_pending >= batch_size:
+                buffered = np.concatenate(pending)
+                n_full = buffered.shape[0] - buffered.shape[0] % batch_size
+                for start in range(0, n_full, batch_size):
+                    codebook.partial_fit(buffered[start:start + batch_size])
+                pending = [buffered[n_full:]]
+                n_pending = buffered.shape[0] - n_full
+        if n_pending > 0:
+            codebook.partial_fit(np.concatenate(pending))
+
+    if codebook_name is not None:
+        # Store the model with the provided name
+        io.save_object(codebook, codebook_name)
+
+    return codebook
+
+
 def create_gmm(D, codebook_name=None):
     from libraries.yael.yael import ynumpy
 
@@ -45,16 +324,63 @@ def create_gmm(D, codebook_name=None):
     return gmm
 
 
-def visual_words(X, y, descriptors_indices, codebook, normalization=None, spatial_pyramid=False):
-    prediction = codebook.predict(X)
+def assign_words(X, codebook, use_cache=True):
+    """
+    Assigns each descriptor to its closest visual word. Assignments are cached on disk (in the ignore folder, created
+    if missing) as compact uint16 arrays keyed by a fingerprint of the descriptors and of the codebook, so they are
+    only computed on a cache miss. The cache pays off for the descriptors of whole sets, which are assigned again in
+    every experiment; per-image calls at test time should disable it, since each one would write its own file.
+
+    :param X: Descriptors matrix with dimensions (n_descriptors, n_features)
+    :type X: numpy.ndarray
+    :param codebook: Trained codebook
+    :type codebook: sklearn.cluster.MiniBatchKMeans
+    :param use_cache: Look up and store the assignments in the cache
+    :type use_cache: bool
+
+    :return: Visual word of each descriptor
+    :rtype: numpy.ndarray
+    """
+    if not use_cache:
+        return codebook.predict(X)
+
+    cache_name = 'words_{}_{}'.format(io.fingerprint(X), io.fingerprint(codebook.cluster_centers_))
+    try:
+        return io.load_object(cache_name, ignore=True)
+    except (IOError, EOFError):
+        pass
+
+    dtype = np.uint16 if codebook.cluster_centers_.shape[0] <= np.iinfo(np.uint16).max + 1 else np.int32
+    prediction = codebook.predict(X).astype(dtype)
+    try:
+        io.save_object(prediction, cache_name, ignore=True)
+    except (IOError, OSError) as e:
+        # The cache is an optimization, failing to store it is not an error, but it is reported
+        io.log('Could not store the visual words assignments in the cache: {}'.format(e), out='stderr')
+
+    return prediction
+
+
+def visual_words(X, y, descriptors_indices, codebook, normalization=None, spatial_pyramid=False,
+                 cache_assignments=True, sparse=False, compact=False):
+    # Compact pyramids (see build_pyramid) are the raw counts of the finest level, used with the 'pyramid_compact'
+    # kernel of classification, which expands them
+    if compact and (not spatial_pyramid or normalization is not None):
+        raise ValueError('Compact representations are only built for spatial pyramids, without normalization')
+    prediction = assign_words(X, codebook, use_cache=cache_assignments)
     if not spatial_pyramid:
-        v_words = np.array([np.bincount(prediction[descriptors_indices == i], minlength=settings.codebook_size) for i in
-                            range(0, descriptors_indices.max() + 1)], dtype=np.float64)
+        if sparse:
+            v_words = _sparse_histograms(descriptors_indices, prediction, settings.codebook_size)
+        else:
+            v_words = np.array([np.bincount(prediction[descriptors_indices == i], minlength=settings.codebook_size)
+                                for i in range(0, descriptors_indices.max() + 1)], dtype=np.float64)
     else:
-        v_words = build_pyramid(prediction, descriptors_indices)
+        v_words = build_pyramid(prediction, descriptors_indices, sparse=sparse, compact=compact)
 
     # Normalization
-    if normalization == 'l1':
+    if sparse and normalization in ('l1', 'l2'):
+        vis_words = preprocessing.normalize(v_words, norm=normalization)
+    elif normalization == 'l1':
         vis_words = v_words / np.sum(np.abs(v_words), axis=1, keepdims=True)
     elif normalization == 'l2':
         vis_words = v_words / np.linalg.norm(v_words, axis=1, keepdims=True)
@@ -83,7 +409,7 @@ def fisher_vectors(X, y, descriptors_indices, codebook, normalization=None, spat
     if normalization == 'l1':
         fisher_vect = fv / np.sum(np.abs(fv), axis=1, keepdims=True)
     elif normalization == 'l2':
-        fisher_vect = fv / np.linalg.norm(fv, keepdims=True)
+        fisher_vect = fv / np.linalg.norm(fv, axis=1, keepdims=True)
     elif normalization == 'power':
         fisher_vect = np.multiply(np.sign(fv), np.sqrt(np.absolute(fv)))
     else:
@@ -93,34 +419,50 @@ def fisher_vectors(X, y, descriptors_indices, codebook, normalization=None, spat
     return fisher_vect, np.array(labels)
 
 
-def build_pyramid(prediction, descriptors_indices):
-    levels = settings.pyramid_levels
-    keypoints_shape = map(int, settings.get_keypoints_shape())
-    kp_i = keypoints_shape[0]
-    kp_j = keypoints_shape[1]
+def _sparse_histograms(rows, columns, n_columns):
+    # Duplicated (row, column) entries are summed up when converting to CSR
+    n_rows = rows.max() + 1
+    return sp.coo_matrix((np.ones(rows.shape[0], dtype=np.float64), (rows, columns)),
+                         shape=(n_rows, n_columns)).tocsr()
 
-    v_words = []
 
-    # Build representation for each image
-    for i in range(0, descriptors_indices.max() + 1):
+def build_pyramid(prediction, descriptors_indices, sparse=False, compact=False):
+    """
+    Builds the spatial pyramid representation of each image: the concatenation, level by level, of the histogram of
+    visual words of each cell of the grid of that level.
 
-        image_predictions = prediction[descriptors_indices == i]
-        image_predictions_grid = np.reshape(image_predictions, keypoints_shape)
+    The compact representation only stores the uint16 histograms of the finest level, since every coarser cell is the
+    sum of its finest cells. It can be expanded with pyramid.expand_pyramid, or used directly by the kernels with
+    compact=True.
 
-        im_representation = []
+    :param prediction: Visual word of each descriptor
+    :type prediction: numpy.ndarray
+    :param descriptors_indices: Image index of each descriptor
+    :type descriptors_indices: numpy.ndarray
+    :param sparse: Return a scipy.sparse CSR matrix instead of a dense array
+    :type sparse: bool
+    :param compact: Return the compact representation (finest level only)
+    :type compact: bool
 
-        for level in range(0, len(levels)):
-            num_rows = levels[level][0]
-            num_cols = levels[level][1]
-            step_i = int(math.ceil(float(kp_i) / float(num_rows)))
-            step_j = int(math.ceil(float(kp_j) / float(num_cols)))
+    :return: Pyramid representations with dimensions (n_images, n_cells * codebook_size)
+    :rtype: numpy.ndarray, scipy.sparse.csr_matrix
+    """
+    layout = pyramid.pyramid_layout()
+    if compact:
+        if sparse:
+            raise ValueError('The compact pyramid representation is dense')
+        # Validate that the coarser levels can be derived from the finest one
+        pyramid.cell_parents(layout)
+        layout = [layout[pyramid.finest_level(layout)]]
 
-            for i in range(0, kp_i, step_i):
-                for j in range(0, kp_j, step_j):
-                    hist = np.array(np.bincount(image_predictions_grid[i:i + step_i, j:j + step_j].reshape(-1),
-                                                minlength=settings.codebook_size))
-                    im_representation = np.hstack((im_representation, hist))
+    columns, n_columns = pyramid.pyramid_columns(prediction, descriptors_indices, layout, settings.codebook_size)
+    n_images = descriptors_indices.max() + 1
+    rows = np.tile(descriptors_indices, len(columns))
+    columns = np.concatenate(columns)
 
-        v_words.append(im_representation)
+    if sparse:
+        return _sparse_histograms(rows, columns, n_columns)
 
-    return np.array(v_words, dtype=np.float64)
+    counts = np.bincount(rows * n_columns + columns, minlength=n_images * n_columns)
+    dtype = np.uint16 if compact else np.float64
+    return np.asarray(counts, dtype=dtype).reshape(n_images, n_columns)
@@ -1,138 +1,379 @@
+from collections import OrderedDict
+import os
+
+import joblib
+import sklearn.base as base
+import sklearn.calibration as calibration
 import sklearn.decomposition as decomposition
+import sklearn.linear_model as linear_model
+import sklearn.model_selection as model_selection
+import sklearn.pipeline as pipeline
 import sklearn.preprocessing as preprocessing
 import sklearn.svm as svm
 
+import mlcv.feature_maps as feature_maps
 import mlcv.input_output as io
 import mlcv.kernels as kernels
+import mlcv.pyramid as pyramid
+import mlcv.settings as settings
+import mlcv.svm_decision as svm_decision
 
 import numpy as np
 
+# Kernels that can be used in precomputed mode
+KERNELS = {
+    'intersection': kernels.intersection_kernel,
+    'pyramid': kernels.pyramid_kernel,
+    'pyramid_compact': kernels.compact_pyramid_kernel,
+    'chi2': kernels.chi2_kernel,
+    'hellinger': kernels.hellinger_kernel,
+    'generalized_intersection': kernels.generalized_intersection_kernel
+}
 
-def train_linear_svm(X, y, C=1, standardize=True, dim_reduction=23, save_scaler=False, save_pca=False,
-                     model_name=None, liblinear=False):
-    # PCA for dimensionality reduction if necessary
-    pca = None
-    if dim_reduction is not None and dim_reduction > 0:
-        pca = decomposition.PCA(n_components=dim_reduction)
-        pca.fit(X)
-        X = pca.transform(X)
+# Kernels whose features depend on settings.pyramid_levels, which is part of their cache keys
+PYRAMID_KERNELS = ('pyramid', 'pyramid_compact')
 
-    # Standardize the data before classification if necessary
-    std_scaler = None
-    if standardize:
-        std_scaler = preprocessing.StandardScaler()
-        std_scaler.fit(X)
-        X_std = std_scaler.transform(X)
-    else:
-        X_std = X
+# Number of Gram matrices kept in the memory cache
+GRAM_CACHE_SIZE = 2
 
-    # Instance of SVM classifier
-    clf = svm.LinearSVC(C=C, max_iter=5000, tol=1e-4) if liblinear else svm.SVC(kernel='linear', C=C, probability=True)
+# How the SVMs estimate class scores: Platt scaling by libsvm (an internal 5-fold cross-validation), the raw
+# decision function, or a logistic regression fitted once on the decision values of a held-out split
+PROBABILITY_MODES = ('platt', 'decision', 'calibrated')
+# Fraction of the training samples held out to fit the calibration of the 'calibrated' mode
+CALIBRATION_SIZE = 0.2
 
-    if model_name is not None:
-        # Try to load a previously trained model
-        try:
-            clf = io.load_object(model_name)
-        except (IOError, EOFError):
-            clf.fit(X_std, y)
-            # Store the model with the provided name
-            io.save_object(clf, model_name)
-    else:
-        clf.fit(X_std, y)
+# Solvers of the linear SVMs: libsvm (quadratic or worse in the number of samples), liblinear in the dual (fast when
+# n_samples < n_features) or in the primal (fast when n_samples > n_features), and stochastic gradient descent
+LINEAR_SOLVERS = ('auto', 'libsvm', 'liblinear_dual', 'liblinear_primal', 'sgd')
 
-    if save_scaler:
-        io.save_object(std_scaler, save_scaler)
+# Kernels evaluated by libsvm itself. Any other kernel of ParallelSVC is a key of KERNELS, used in precomputed mode
+LIBSVM_KERNELS = svm_decision.LIBSVM_KERNELS
 
-    if save_pca:
-        io.save_object(pca, save_pca)
+_gram_cache = OrderedDict()
 
-    return clf, std_scaler, pca
 
+def _cache_gram(key, gram):
+    _gram_cache[key] = gram
+    while len(_gram_cache) > GRAM_CACHE_SIZE:
+        _gram_cache.popitem(last=False)
 
-def train_poly_svm(X, y, C=1, degree=3, gamma='auto', coef0=0.0, standardize=True, dim_reduction=None,
-                   save_scaler=False, save_pca=False, model_name=None):
-    # PCA for dimensionality reduction if necessary
-    pca = None
-    if dim_reduction is not None and dim_reduction > 0:
-        pca = decomposition.PCA(n_components=dim_reduction)
-        pca.fit(X)
-        X = pca.transform(X)
 
-    # Standardize the data before classification if necessary
-    std_scaler = None
-    if standardize:
-        std_scaler = preprocessing.StandardScaler()
-        std_scaler.fit(X)
-        X_std = std_scaler.transform(X)
-    else:
-        X_std = X
+def gram_matrix(X, kernel='intersection', cache='memory'):
+    """
+    Computes the training Gram matrix of a kernel, cached by a fingerprint of the features and the kernel, so that
+    repeated trainings on the same data (e.g. for different values of C) compute it only once.
 
-    # Instance of SVM classifier
-    clf = svm.SVC(kernel='poly', C=C, degree=degree, gamma=gamma, coef0=coef0, probability=True)
+    :param X: Training matrix with dimensions (n_samples, n_features), or an IncrementalGram of the kernel, whose
+              Gram matrix is returned
+    :type X: numpy.ndarray, mlcv.kernels.IncrementalGram
+    :param kernel: Name of the kernel (a key of KERNELS)
+    :type kernel: basestring
+    :param cache: Where the Gram matrix is cached: 'memory', 'disk' (a memory-mapped .npy file in the ignore folder,
+                  opened read-only, which can be passed to parallel workers without copying it) or None
+    :type cache: basestring
+    :return: Gram matrix with dimensions (n_samples, n_samples)
+    :rtype: numpy.ndarray, numpy.memmap
+    """
+    if isinstance(X, kernels.IncrementalGram):
+        if X.kernel is not KERNELS[kernel]:
+            raise ValueError('The incremental Gram matrix was not computed with the {} kernel'.format(kernel))
+        if cache == 'memory':
+            # Its fingerprint is the one of its features, so later calls with the features alone (e.g. by a
+            # ParallelSVC trained on them) find its Gram matrix instead of recomputing it
+            _cache_gram('gram_{}_{}'.format(kernel, X.fingerprint), X.gram)
+        return X.gram
+    if cache is None:
+        return KERNELS[kernel](X, X)
 
-    if model_name is not None:
-        # Try to load a previously trained model
+    key = 'gram_{}_{}'.format(kernel, io.fingerprint(X, settings.pyramid_levels if kernel in PYRAMID_KERNELS else None))
+    if cache == 'memory':
+        if key not in _gram_cache:
+            _cache_gram(key, KERNELS[kernel](X, X))
+        return _gram_cache[key]
+    elif cache == 'disk':
         try:
-            clf = io.load_object(model_name)
-        except (IOError, EOFError):
-            clf.fit(X_std, y)
-            # Store the model with the provided name
-            io.save_object(clf, model_name)
+            return io.load_array(key, mmap_mode='r', ignore=True)
+        except IOError:
+            # The tiles are written directly to the file, so the Gram matrix is never stored in memory. It is renamed
+            # once complete, so an interrupted computation is never loaded as a cached one
+            path = io.array_path(key, ignore=True, create_folder=True)
+            KERNELS[kernel](X, X, out=path + '.partial')
+            os.rename(path + '.partial', path)
+            return io.load_array(key, mmap_mode='r', ignore=True)
     else:
-        clf.fit(X_std, y)
+        raise ValueError('Unknown Gram matrix cache: {}'.format(cache))
 
-    if save_scaler:
-        io.save_object(std_scaler, save_scaler)
 
-    if save_pca:
-        io.save_object(pca, save_pca)
+def _fit_svm(clf, X, y, kernel=None, gram_cache='memory', gram=None):
+    if getattr(clf, 'kernel', None) != 'precomputed':
+        clf.fit(X, y)
+        return clf
 
-    return clf, std_scaler, pca
+    clf.fit(gram_matrix(X, kernel, cache=gram_cache) if gram is None else gram, y)
+    # Keep the support vectors, so that only K(X_test, support vectors) is computed on prediction
+    clf.kernel_name_ = kernel
+    clf.support_features_ = X[clf.support_]
+    clf.n_fit_samples_ = X.shape[0]
+    return clf
 
 
-def train_rbf_svm(X, y, C=5, gamma=0.1, standardize=True, dim_reduction=23,
-                  save_scaler=False, save_pca=False, model_name=None):
-    # PCA for dimensionality reduction if necessary
-    pca = None
-    if dim_reduction is not None and dim_reduction > 0:
-        pca = decomposition.PCA(n_components=dim_reduction)
-        pca.fit(X)
-        X = pca.transform(X)
+def _precomputed_test_gram(X, clf):
+    # Columns of the training samples which are not support vectors are never used by libsvm
+    gram = np.zeros((X.shape[0], clf.n_fit_samples_))
+    gram[:, clf.support_] = KERNELS[clf.kernel_name_](X, clf.support_features_)
+    return gram
 
-    # Standardize the data before classification if necessary
-    std_scaler = None
-    if standardize:
-        std_scaler = preprocessing.StandardScaler()
-        std_scaler.fit(X)
-        X_std = std_scaler.transform(X)
-    else:
-        X_std = X
 
-    clf = svm.SVC(kernel='rbf', C=C, gamma=gamma, probability=True)
+def _svc(probability='platt', **params):
+    if probability not in PROBABILITY_MODES:
+        raise ValueError('Unknown probability mode: {}'.format(probability))
+    return svm.SVC(probability=probability == 'platt', decision_function_shape='ovr', **params)
 
-    if model_name is not None:
-        # Instance of SVM classifier
-        # Try to load a previously trained model
-        try:
-            clf = io.load_object(model_name)
-        except (IOError, EOFError):
-            clf.fit(X_std, y)
-            # Store the model with the provided name
-            io.save_object(clf, model_name)
-    else:
-        clf.fit(X_std, y)
 
-    if save_scaler:
-        io.save_object(std_scaler, save_scaler)
+def _decision_scores(clf, X):
+    # One column per class in every case, so that the scores of the descriptors of an image can be summed up
+    scores = clf.decision_function(X)
+    if scores.ndim == 1:
+        scores = np.column_stack([-scores, scores])
+    return scores
 
-    if save_pca:
-        io.save_object(pca, save_pca)
 
-    return clf, std_scaler, pca
+def _fit_calibrated_svm(clf, X, y, kernel=None, gram_cache='memory', gram=None):
+    # The SVM is fitted once on a split of the samples, and a logistic regression on its decision values on the
+    # held-out ones, instead of the 5 additional fits of libsvm's Platt scaling
+    y = np.asarray(y)
+    split = model_selection.StratifiedShuffleSplit(n_splits=1, test_size=CALIBRATION_SIZE, random_state=0)
+    train, held_out = next(split.split(np.zeros(len(y)), y))
 
+    _fit_svm(clf, X[train], y[train], kernel=kernel, gram_cache=gram_cache,
+             gram=None if gram is None else gram[np.ix_(train, train)])
+    X_held_out = X[held_out]
+    if getattr(clf, 'kernel', None) == 'precomputed':
+        X_held_out = _precomputed_test_gram(X_held_out, clf)
+    clf.calibrator_ = linear_model.LogisticRegression().fit(_decision_scores(clf, X_held_out), y[held_out])
+    return clf
+
+
+def probability_mode(clf):
+    """
+    :return: How the classifier estimates class scores (one of PROBABILITY_MODES)
+    :rtype: basestring
+    """
+    mode = getattr(clf, 'probability_mode_', None)
+    if mode is not None:
+        return mode
+    return 'platt' if hasattr(clf, 'predict_proba') and getattr(clf, 'probability', True) else 'decision'
+
+
+def _cv_results(C_values, scores):
+    # Same structure as RandomizedSearchCV.cv_results_, with scores of dimensions (n_C_values, n_folds)
+    scores = np.asarray(scores)
+    mean_scores = scores.mean(axis=1)
+    results = {
+        'param_C': np.ma.MaskedArray(np.asarray(C_values, dtype=np.float64), mask=False),
+        'params': [{'C': C} for C in C_values],
+        'mean_test_score': mean_scores,
+        'std_test_score': scores.std(axis=1),
+        'rank_test_score': np.asarray(np.argsort(np.argsort(-mean_scores, kind='mergesort')) + 1, dtype=np.int32)
+    }
+    for fold in range(scores.shape[1]):
+        results['split{}_test_score'.format(fold)] = scores[:, fold]
+    return results
+
+
+def cross_validate_precomputed_svm(X, y, C_values, kernel='intersection', cv=4, gram_cache='memory', n_jobs=1,
+                                   gram=None):
+    """
+    Cross-validates a kernel SVM for several values of C computing the Gram matrix only once: the training and
+    validation Gram matrices of each fold are slices of it.
+
+    :param X: Training matrix with dimensions (n_samples, n_features), or an IncrementalGram of the kernel
+    :type X: numpy.ndarray, mlcv.kernels.IncrementalGram
+    :param y: Labels of the training samples
+    :type y: numpy.ndarray
+    :param C_values: Values of C to be evaluated
+    :type C_values: list
+    :param kernel: Name of the kernel (a key of KERNELS)
+    :type kernel: basestring
+    :param cv: Number of stratified folds
+    :type cv: int
+    :param gram_cache: Cache of the Gram matrix (see gram_matrix)
+    :type gram_cache: basestring
+    :param n_jobs: Number of threads used to fit the SVMs
+    :type n_jobs: int
+    :param gram: Gram matrix of X, if already computed
+    :type gram: numpy.ndarray
+    :return: Accuracy of each value of C, with the same structure as RandomizedSearchCV.cv_results_
+    :rtype: dict
+    """
+    y = np.asarray(y)
+    if gram is None:
+        gram = gram_matrix(X, kernel, cache=gram_cache)
+    folds = list(model_selection.StratifiedKFold(n_splits=cv).split(np.zeros(len(y)), y))
+
+    def fold_scores(train, test):
+        gram_train = gram[np.ix_(train, train)]
+        gram_test = gram[np.ix_(test, train)]
+        return [svm.SVC(kernel='precomputed', C=C).fit(gram_train, y[train]).score(gram_test, y[test])
+                for C in C_values]
+
+    scores = joblib.Parallel(n_jobs=n_jobs, backend='threading')(
+        joblib.delayed(fold_scores)(train, test) for train, test in folds
+    )
+    return _cv_results(C_values, np.transpose(scores))
+
+
+# Models of regularization_path, and whether their solver is warm-started from the solution of the previous C
+PATH_MODELS = {
+    'sgd': True,
+    'logistic': True,
+    'linear_svm': False,
+    'precomputed': False
+}
+
+
+def _path_params(model, C, n_samples):
+    if model == 'sgd':
+        return {'alpha': 1.0 / (C * n_samples)}
+    return {'C': C}
+
+
+def _path_estimator(model):
+    if model == 'sgd':
+        return linear_model.SGDClassifier(loss='hinge', warm_start=PATH_MODELS[model])
+    elif model == 'logistic':
+        return linear_model.LogisticRegression(solver='lbfgs', warm_start=PATH_MODELS[model])
+    elif model == 'linear_svm':
+        # liblinear does not support warm starts, but each fit is cheap
+        return svm.LinearSVC(max_iter=5000, tol=1e-4)
+
+
+def regularization_path(X, y, C_values, model='sgd', kernel='intersection', cv=4, gram_cache='memory', n_jobs=1):
+    """
+    Cross-validates a linear model for several values of C, fitting them in increasing order of C in each fold so
+    that every fit is warm-started from the weights of the previous one, which is already close to its solution.
+
+    Models (see PATH_MODELS):
+    - 'sgd': linear SVM (hinge loss) trained by SGD, warm-started
+    - 'logistic': logistic regression trained by L-BFGS, warm-started
+    - 'linear_svm': LinearSVC, whose liblinear solver cannot be warm-started
+    - 'precomputed': kernel SVM on the Gram matrix of the kernel, computed once (see cross_validate_precomputed_svm).
+      libsvm cannot be warm-started from the dual coefficients through sklearn, so each C is fitted from scratch
+
+    :param X: Training matrix with dimensions (n_samples, n_features)
+    :type X: numpy.ndarray
+    :param y: Labels of the training samples
+    :type y: numpy.ndarray
+    :param C_values: Values of C to be evaluated, in any order
+    :type C_values: list
+    :param model: Model to be cross-validated
+    :type model: basestring
+    :param kernel: Name of the kernel (a key of KERNELS) of the 'precomputed' model
+    :type kernel: basestring
+    :param cv: Number of stratified folds
+    :type cv: int
+    :param gram_cache: Cache of the Gram matrix of the 'precomputed' model (see gram_matrix)
+    :type gram_cache: basestring
+    :param n_jobs: Number of threads, each one fitting the path of a fold
+    :type n_jobs: int
+    :return: Accuracy of each value of C, in the given order, with the same structure as
+             RandomizedSearchCV.cv_results_
+    :rtype: dict
+    """
+    if model == 'precomputed':
+        return cross_validate_precomputed_svm(X, y, C_values, kernel=kernel, cv=cv, gram_cache=gram_cache,
+                                              n_jobs=n_jobs)
+    if model not in PATH_MODELS:
+        raise ValueError('Unknown regularization path model: {}'.format(model))
+
+    y = np.asarray(y)
+    order = np.argsort(C_values, kind='mergesort')
+    folds = list(model_selection.StratifiedKFold(n_splits=cv).split(np.zeros(len(y)), y))
+
+    def fold_scores(train, test):
+        clf = _path_estimator(model)
+        X_train, y_train = X[train], y[train]
+        scores = np.zeros(len(C_values))
+        for i in order:
+            clf.set_params(**_path_params(model, C_values[i], len(train)))
+            clf.fit(X_train, y_train)
+            scores[i] = clf.score(X[test], y[test])
+        return scores
+
+    scores = joblib.Parallel(n_jobs=n_jobs, backend='threading')(
+        joblib.delayed(fold_scores)(train, test) for train, test in folds
+    )
+    return _cv_results(C_values, np.transpose(scores))
+
+
+def _describe(value):
+    # Hyperparameters in a form whose fingerprint does not depend on the process (e.g. no memory addresses)
+    if hasattr(value, 'get_params'):
+        return type(value).__name__
+    elif callable(value):
+        return '{}.{}'.format(getattr(value, '__module__', None), getattr(value, '__name__', type(value).__name__))
+    elif isinstance(value, dict):
+        return dict((key, _describe(item)) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        return [_describe(item) for item in value]
+    return value
+
+
+def training_fingerprint(X, y, clf, standardize=False, dim_reduction=None, kernel=None, probability=None):
+    """
+    Computes the fingerprint that identifies a trained model: the training data, the labels, every hyperparameter of
+    the classifier and the PCA and standardization settings.
+
+    :param X: Training matrix with dimensions (n_samples, n_features)
+    :type X: numpy.ndarray
+    :param y: Labels of the training samples
+    :type y: numpy.ndarray
+    :param clf: Classifier, not fitted
+    :type clf: sklearn.base.BaseEstimator
+    :param standardize: Whether the data is standardized
+    :type standardize: bool
+    :param dim_reduction: Number of PCA components (None or 0 for no PCA)
+    :type dim_reduction: int
+    :param kernel: Name of the kernel (a key of KERNELS), if any
+    :type kernel: basestring
+    :param probability: Probability mode (one of PROBABILITY_MODES), if any
+    :type probability: basestring
+    :return: Hexadecimal digest
+    :rtype: basestring
+    """
+    config = {
+        'classifier': type(clf).__name__,
+        'params': _describe(clf.get_params(deep=True)),
+        'standardize': bool(standardize),
+        'dim_reduction': dim_reduction if dim_reduction else None,
+        'kernel': kernel,
+        'pyramid_levels': settings.pyramid_levels if kernel in PYRAMID_KERNELS else None,
+        'probability': probability,
+        'calibration_size': CALIBRATION_SIZE if probability == 'calibrated' else None
+    }
+    return io.fingerprint(X, np.asarray(y), config)
+
+
+def _train_svm(X, y, clf, standardize=True, dim_reduction=None, save_scaler=False, save_pca=False, model_name=None,
+               kernel=None, gram_cache='memory', probability=None, gram=None):
+    # Shared by the train_*_svm functions. When model_name is given, the PCA, the scaler and the classifier are
+    # cached together in the ignore folder under model_name and the training fingerprint, so a cached model is only
+    # reused when neither the data nor any setting changed, and then nothing is fitted. Only the classifier is stored
+    # in the models folder, under model_name alone, which is where the prediction scripts load it from
+    if gram is not None and (standardize or (dim_reduction is not None and dim_reduction > 0)):
+        raise ValueError('A precomputed Gram matrix is only valid without standardization and PCA')
+    cache_name = None
+    if model_name is not None:
+        cache_name = '{}_{}'.format(model_name, training_fingerprint(X, y, clf, standardize, dim_reduction, kernel,
+                                                                     probability))
+        try:
+            clf, std_scaler, pca = io.load_object(cache_name, ignore=True)
+        except (IOError, EOFError):
+            pass
+        else:
+            io.save_object(clf, model_name)
+            return _save_preprocessing(clf, std_scaler, pca, save_scaler, save_pca)
 
-def train_sigmoid_svm(X, y, C=1, gamma='auto', coef0=0.0, standardize=True, dim_reduction=None,
-                      save_scaler=False, save_pca=False, model_name=None):
     # PCA for dimensionality reduction if necessary
     pca = None
     if dim_reduction is not None and dim_reduction > 0:
@@ -149,20 +390,22 @@ def train_sigmoid_svm(X, y, C=1, gamma='auto', coef0=0.0, standardize=True, dim_
     else:
         X_std = X
 
-    clf = svm.SVC(kernel='sigmoid', C=C, gamma=gamma, coef0=coef0, probability=True)
+    if probability == 'calibrated':
+        _fit_calibrated_svm(clf, X_std, y, kernel=kernel, gram_cache=gram_cache, gram=gram)
+    else:
+        _fit_svm(clf, X_std, y, kernel=kernel, gram_cache=gram_cache, gram=gram)
+    if probability is not None:
+        clf.probability_mode_ = probability
 
     if model_name is not None:
-        # Instance of SVM classifier
-        # Try to load a previously trained model
-        try:
-            clf = io.load_object(model_name)
-        except (IOError, EOFError):
-            clf.fit(X_std, y)
-            # Store the model with the provided name
-            io.save_object(clf, model_name)
-    else:
-        clf.fit(X_std, y)
+        # Store the model with the provided name
+        io.save_object((clf, std_scaler, pca), cache_name, ignore=True)
+        io.save_object(clf, model_name)
+
+    return _save_preprocessing(clf, std_scaler, pca, save_scaler, save_pca)
 
+
+def _save_preprocessing(clf, std_scaler, pca, save_scaler, save_pca):
     if save_scaler:
         io.save_object(std_scaler, save_scaler)
 
@@ -172,80 +415,691 @@ def train_sigmoid_svm(X, y, C=1, gamma='auto', coef0=0.0, standardize=True, dim_
     return clf, std_scaler, pca
 
 
-def train_intersection_svm(X, y, C=1, standardize=True, dim_reduction=None,
-                           save_scaler=False, save_pca=False, model_name=None):
-    # PCA for dimensionality reduction if necessary
-    pca = None
-    if dim_reduction is not None and dim_reduction > 0:
-        pca = decomposition.PCA(n_components=dim_reduction)
-        pca.fit(X)
-        X = pca.transform(X)
+def select_linear_solver(n_samples, n_features):
+    """
+    Selects the solver of a linear SVM from the shape of the training data: liblinear in the dual when there are
+    fewer samples than features, and in the primal otherwise, whose cost grows linearly with the number of samples.
+    libsvm and SGD (slower than the primal solver on low-dimensional descriptors) are only used when requested.
 
-    # Standardize the data before classification if necessary
-    std_scaler = None
-    if standardize:
-        std_scaler = preprocessing.StandardScaler()
-        std_scaler.fit(X)
-        X_std = std_scaler.transform(X)
-    else:
-        X_std = X
+    :return: Name of the solver (one of LINEAR_SOLVERS)
+    :rtype: basestring
+    """
+    if n_samples < n_features:
+        return 'liblinear_dual'
+    return 'liblinear_primal'
 
-    clf = svm.SVC(kernel=kernels.intersection_kernel, C=C, probability=True)
 
-    if model_name is not None:
-        # Instance of SVM classifier
-        # Try to load a previously trained model
-        try:
-            clf = io.load_object(model_name)
-        except (IOError, EOFError):
-            clf.fit(X_std, y)
-            # Store the model with the provided name
-            io.save_object(clf, model_name)
+def _linear_svm(solver, C, n_samples, probability):
+    # The solver is set before the fit, so that the models stored by _train_svm report it
+    if solver == 'libsvm':
+        clf = _svc(kernel='linear', C=C, probability=probability)
+        clf.solver_ = solver
+        return clf
+    elif solver == 'liblinear_dual':
+        clf = svm.LinearSVC(C=C, dual=True, max_iter=5000, tol=1e-4)
+    elif solver == 'liblinear_primal':
+        clf = svm.LinearSVC(C=C, dual=False, tol=1e-4)
+    elif solver == 'sgd':
+        clf = linear_model.SGDClassifier(loss='hinge', alpha=1.0 / (C * n_samples))
     else:
-        clf.fit(X_std, y)
+        raise ValueError('Unknown linear SVM solver: {}'.format(solver))
 
-    if save_scaler:
-        io.save_object(std_scaler, save_scaler)
+    if probability == 'platt':
+        # Sigmoid calibration on 3 folds, since liblinear and SGD do not estimate probabilities
+        clf = calibration.CalibratedClassifierCV(clf, method='sigmoid', cv=3)
+    clf.solver_ = solver
+    return clf
 
-    if save_pca:
-        io.save_object(pca, save_pca)
 
+def train_linear_svm(X, y, C=1, standardize=True, dim_reduction=23, save_scaler=False, save_pca=False,
+                     model_name=None, liblinear=False, probability='platt', solver='auto'):
+    """
+    Trains a linear SVM. The solver is selected from the shape of the training data by default (see
+    select_linear_solver), so that large sets of descriptors train in seconds, and is stored in the solver_
+    attribute of the classifier.
+
+    With probability='platt' and a liblinear or SGD solver (the default), the classifier is a CalibratedClassifierCV
+    that averages the calibrated probabilities of 3 linear SVMs. It has no single weight vector, so it can neither be
+    folded (fold_linear_model) nor exported (export.export_pipeline): train with probability='decision' or
+    'calibrated' (which keeps a single SVM) for those.
+
+    :param liblinear: Train a plain LinearSVC in the dual, without probability estimates (solver='liblinear_dual'
+                      and probability='decision')
+    :type liblinear: bool
+    :param probability: How class scores are estimated (one of PROBABILITY_MODES). Platt scaling is done by libsvm,
+                        or by a 3-fold sigmoid calibration with the other solvers
+    :type probability: basestring
+    :param solver: Solver (one of LINEAR_SOLVERS)
+    :type solver: basestring
+    :return: The classifier, the scaler and the PCA
+    :rtype: tuple
+    """
+    if solver not in LINEAR_SOLVERS:
+        raise ValueError('Unknown linear SVM solver: {}'.format(solver))
+    if liblinear:
+        solver, probability = 'liblinear_dual', 'decision'
+    if solver == 'auto':
+        n_features = dim_reduction if dim_reduction else X.shape[1]
+        solver = select_linear_solver(X.shape[0], n_features)
+
+    # Instance of SVM classifier
+    clf = _linear_svm(solver, C, X.shape[0], probability)
+    clf, std_scaler, pca = _train_svm(X, y, clf, standardize=standardize, dim_reduction=dim_reduction,
+                                      save_scaler=save_scaler, save_pca=save_pca, model_name=model_name,
+                                      probability=probability)
     return clf, std_scaler, pca
 
 
+def train_poly_svm(X, y, C=1, degree=3, gamma='auto', coef0=0.0, standardize=True, dim_reduction=None,
+                   save_scaler=False, save_pca=False, model_name=None, probability='platt'):
+    # Instance of SVM classifier
+    clf = _svc(kernel='poly', C=C, degree=degree, gamma=gamma, coef0=coef0, probability=probability)
+    return _train_svm(X, y, clf, standardize=standardize, dim_reduction=dim_reduction, save_scaler=save_scaler,
+                      save_pca=save_pca, model_name=model_name, probability=probability)
+
+
+def train_rbf_svm(X, y, C=5, gamma=0.1, standardize=True, dim_reduction=23,
+                  save_scaler=False, save_pca=False, model_name=None, probability='platt'):
+    # Instance of SVM classifier
+    clf = _svc(kernel='rbf', C=C, gamma=gamma, probability=probability)
+    return _train_svm(X, y, clf, standardize=standardize, dim_reduction=dim_reduction, save_scaler=save_scaler,
+                      save_pca=save_pca, model_name=model_name, probability=probability)
+
+
+def train_sigmoid_svm(X, y, C=1, gamma='auto', coef0=0.0, standardize=True, dim_reduction=None,
+                      save_scaler=False, save_pca=False, model_name=None, probability='platt'):
+    # Instance of SVM classifier
+    clf = _svc(kernel='sigmoid', C=C, gamma=gamma, coef0=coef0, probability=probability)
+    return _train_svm(X, y, clf, standardize=standardize, dim_reduction=dim_reduction, save_scaler=save_scaler,
+                      save_pca=save_pca, model_name=model_name, probability=probability)
+
+
+def train_intersection_svm(X, y, C=1, standardize=True, dim_reduction=None,
+                           save_scaler=False, save_pca=False, model_name=None, precomputed=False, gram_cache='memory',
+                           probability='platt'):
+    return train_kernel_svm(X, y, C=C, kernel='intersection', standardize=standardize, dim_reduction=dim_reduction,
+                            save_scaler=save_scaler, save_pca=save_pca, model_name=model_name,
+                            precomputed=precomputed, gram_cache=gram_cache, probability=probability)
+
+
 def train_pyramid_svm(X, y, C=1, standardize=True, dim_reduction=None,
-                           save_scaler=False, save_pca=False, model_name=None):
+                           save_scaler=False, save_pca=False, model_name=None, precomputed=False, gram_cache='memory',
+                           probability='platt', compact=False):
+    # The pyramid structure of the features must be kept, so PCA is never applied. Compact pyramids (see
+    # bovw.visual_words) are raw counts of the finest level, which are expanded by the kernel, so they are never
+    # standardized
+    if compact and standardize:
+        raise ValueError('Compact pyramids cannot be standardized')
+    kernel = 'pyramid_compact' if compact else 'pyramid'
+    clf, std_scaler, _ = train_kernel_svm(X, y, C=C, kernel=kernel, standardize=standardize, dim_reduction=None,
+                                          save_scaler=save_scaler, model_name=model_name, precomputed=precomputed,
+                                          gram_cache=gram_cache, probability=probability)
+    return clf, std_scaler, None
 
-    # Standardize the data before classification if necessary
-    std_scaler = None
-    if standardize:
-        std_scaler = preprocessing.StandardScaler()
-        std_scaler.fit(X)
-        X_std = std_scaler.transform(X)
+
+def train_kernel_svm(X, y, C=1, kernel='chi2', standardize=False, dim_reduction=None,
+                     save_scaler=False, save_pca=False, model_name=None, precomputed=False, gram_cache='memory',
+                     probability='platt', gram=None):
+    """
+    Trains an SVM with any of the kernels of KERNELS, either as a callable kernel or in precomputed mode (the
+    training Gram matrix is cached by gram_matrix).
+
+    Standardization is disabled by default, since kernels such as chi2 or Hellinger require non-negative features.
+
+    :param X: Training matrix with dimensions (n_samples, n_features), or an IncrementalGram of the kernel, whose
+              Gram matrix is used in precomputed mode
+    :type X: numpy.ndarray, mlcv.kernels.IncrementalGram
+    :param kernel: Name of the kernel (a key of KERNELS)
+    :type kernel: basestring
+    :param gram: Gram matrix of X in precomputed mode, if already computed (only valid without standardization and
+                 PCA)
+    :type gram: numpy.ndarray
+    :param probability: How class scores are estimated (one of PROBABILITY_MODES): 'platt' (libsvm, 5 times the fit
+                        time), 'decision' (raw decision values) or 'calibrated' (a logistic regression on the decision
+                        values of a held-out split)
+    :type probability: basestring
+    :return: The classifier, the scaler and the PCA
+    :rtype: tuple
+    """
+    if isinstance(X, kernels.IncrementalGram):
+        if precomputed and gram is None:
+            gram = gram_matrix(X, kernel)
+        X = X.features
+    if precomputed:
+        clf = _svc(kernel='precomputed', C=C, probability=probability)
     else:
-        X_std = X
+        clf = _svc(kernel=KERNELS[kernel], C=C, probability=probability)
+        gram = None
+    return _train_svm(X, y, clf, standardize=standardize, dim_reduction=dim_reduction, save_scaler=save_scaler,
+                      save_pca=save_pca, model_name=model_name, kernel=kernel, gram_cache=gram_cache,
+                      probability=probability, gram=gram)
 
-    clf = svm.SVC(kernel=kernels.pyramid_kernel, C=C, probability=True)
 
-    if model_name is not None:
-        # Instance of SVM classifier
-        # Try to load a previously trained model
-        try:
-            clf = io.load_object(model_name)
-        except (IOError, EOFError):
-            clf.fit(X_std, y)
-            # Store the model with the provided name
-            io.save_object(clf, model_name)
+def train_additive_svm(X, y, C=1, kernel='intersection', order=1, period=None, standardize=False,
+                       dim_reduction=None, sgd=False, save_scaler=False, save_pca=False, model_name=None):
+    """
+    Trains a linear SVM on the explicit feature map of an additive kernel (intersection or chi2), which
+    approximates the corresponding kernel SVM with training time linear in the number of samples.
+
+    The feature map (and the standardization, which is applied after it) is part of the returned classifier, a
+    sklearn Pipeline, so predict_svm can be used as with any other model. Since LinearSVC does not estimate
+    probabilities, predict_svm returns its decision values as scores.
+
+    :return: The classifier pipeline, None (the scaler is inside the pipeline) and the PCA
+    :rtype: tuple
+    """
+    steps = [('feature_map', preprocessing.FunctionTransformer(
+        feature_maps.homogeneous_kernel_map, validate=False,
+        kw_args={'kernel': kernel, 'order': order, 'period': period}))]
+
+    # Standardize the mapped data before classification if necessary
+    if standardize:
+        steps.append(('std_scaler', preprocessing.StandardScaler(with_mean=False)))
+
+    n_samples = X.shape[0]
+    if sgd:
+        steps.append(('svm', linear_model.SGDClassifier(loss='hinge', alpha=1.0 / (C * n_samples))))
     else:
-        clf.fit(X_std, y)
+        steps.append(('svm', svm.LinearSVC(C=C, max_iter=5000, tol=1e-4)))
+
+    clf, _, pca = _train_svm(X, y, pipeline.Pipeline(steps), standardize=False, dim_reduction=dim_reduction,
+                             save_pca=save_pca, model_name=model_name)
 
     if save_scaler:
-        io.save_object(std_scaler, save_scaler)
+        io.save_object(clf.named_steps.get('std_scaler'), save_scaler)
 
-    return clf, std_scaler, None
+    return clf, None, pca
+
+
+def _fit_binary_svm(data, indices, labels, params, precomputed):
+    # Runs in a worker process, where data is memory-mapped by joblib: only the rows of the sub-problem are copied
+    if precomputed:
+        data = data[np.ix_(indices, indices)]
+    else:
+        data = data[indices]
+    clf = svm.SVC(**params).fit(data, labels)
+    if precomputed:
+        clf.support_indices_ = indices[clf.support_]
+        clf.n_fit_samples_ = len(indices)
+    return clf
+
+
+class ParallelSVC(base.BaseEstimator, base.ClassifierMixin):
+    """
+    Multiclass SVM whose binary sub-problems are trained in parallel processes, instead of sequentially by libsvm.
+
+    With multiclass='ovo', each pair of classes is trained on the samples of both classes in the order libsvm uses
+    (the ones of the first class, then the ones of the second), and the labels are predicted by the same voting,
+    with ties resolved in favour of the lowest class index, so the predictions are identical to the ones of an SVC
+    with the same parameters. With multiclass='ovr', each class is trained against the rest and the class with the
+    highest decision value is predicted.
+
+    The training matrix (or the Gram matrix of the kernels of KERNELS, computed once by gram_matrix) is memory-mapped
+    by joblib and shared by the workers instead of copied to each of them.
+    """
+
+    def __init__(self, C=1.0, kernel='rbf', degree=3, gamma='auto', coef0=0.0, tol=1e-3, cache_size=200, max_iter=-1,
+                 multiclass='ovo', n_jobs=-1, backend=None, gram_cache='memory'):
+        """
+        :param kernel: One of LIBSVM_KERNELS, or the name of a kernel of KERNELS
+        :type kernel: basestring
+        :param multiclass: Decomposition in binary sub-problems: 'ovo' (one-vs-one) or 'ovr' (one-vs-rest)
+        :type multiclass: basestring
+        :param n_jobs: Number of worker processes (-1 for all the cores)
+        :type n_jobs: int
+        :param backend: joblib process backend ('loky' or 'multiprocessing'), or None for the joblib default
+        :type backend: basestring
+        :param gram_cache: Cache of the Gram matrix of the kernels of KERNELS (see gram_matrix)
+        :type gram_cache: basestring
+        """
+        self.C = C
+        self.kernel = kernel
+        self.degree = degree
+        self.gamma = gamma
+        self.coef0 = coef0
+        self.tol = tol
+        self.cache_size = cache_size
+        self.max_iter = max_iter
+        self.multiclass = multiclass
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.gram_cache = gram_cache
+
+    def _binary_problems(self, y):
+        # Samples and labels of each sub-problem, in the order of the columns of _binary_decisions
+        n_classes = len(self.classes_)
+        if self.multiclass == 'ovo':
+            for i in range(n_classes):
+                for j in range(i + 1, n_classes):
+                    indices = np.concatenate([np.flatnonzero(y == i), np.flatnonzero(y == j)])
+                    yield indices, y[indices]
+        elif self.multiclass == 'ovr':
+            for k in range(n_classes):
+                yield np.arange(len(y)), np.asarray(y == k, dtype=np.int32)
+        else:
+            raise ValueError('Unknown multiclass decomposition: {}'.format(self.multiclass))
+
+    def _svc_params(self, X):
+        # gamma is resolved on the whole training set, since 'scale' would otherwise depend on each sub-problem
+        gamma = self.gamma
+        if gamma == 'auto':
+            gamma = 1.0 / X.shape[1]
+        elif gamma == 'scale':
+            gamma = 1.0 / (X.shape[1] * X.var())
+        return {'C': self.C, 'degree': self.degree, 'gamma': gamma, 'coef0': self.coef0, 'tol': self.tol,
+                'cache_size': self.cache_size, 'max_iter': self.max_iter,
+                'kernel': self.kernel if self.kernel in LIBSVM_KERNELS else 'precomputed'}
+
+    def fit(self, X, y):
+        """
+        :param X: Training matrix with dimensions (n_samples, n_features)
+        :type X: numpy.ndarray
+        :param y: Labels of the training samples
+        :type y: numpy.ndarray
+        :return: The fitted classifier
+        :rtype: ParallelSVC
+        """
+        self.classes_, y = np.unique(y, return_inverse=True)
+        precomputed = self.kernel not in LIBSVM_KERNELS
+        params = self._svc_params(X)
+        data = gram_matrix(X, self.kernel, cache=self.gram_cache) if precomputed else X
+
+        self.estimators_ = joblib.Parallel(n_jobs=self.n_jobs, backend=self.backend)(
+            joblib.delayed(_fit_binary_svm)(data, indices, labels, params, precomputed)
+            for indices, labels in self._binary_problems(y)
+        )
 
+        if precomputed:
+            # Union of the support vectors of the sub-problems, so that K(X_test, support vectors) is computed once
+            self.support_ = np.unique(np.concatenate([clf.support_indices_ for clf in self.estimators_]))
+            self.support_features_ = X[self.support_]
+            for clf in self.estimators_:
+                clf.support_columns_ = np.searchsorted(self.support_, clf.support_indices_)
+        return self
 
-def predict_svm(X, svm, std_scaler=None, pca=None, probability=True):
+    def _binary_decisions(self, X):
+        # Decision values with dimensions (n_samples, n_sub_problems), positive for the second class of each one
+        if self.kernel in LIBSVM_KERNELS:
+            return np.column_stack([clf.decision_function(X) for clf in self.estimators_])
+
+        support_gram = KERNELS[self.kernel](X, self.support_features_)
+        decisions = []
+        for clf in self.estimators_:
+            gram = np.zeros((X.shape[0], clf.n_fit_samples_))
+            gram[:, clf.support_] = support_gram[:, clf.support_columns_]
+            decisions.append(clf.decision_function(gram))
+        return np.column_stack(decisions)
+
+    def decision_function(self, X):
+        """
+        :return: Decision values with dimensions (n_samples, n_classes): the decision values of each class against
+                 the rest for 'ovr', and the votes plus the sum of the decision values scaled to (-1/3, 1/3), as in
+                 SVC with decision_function_shape='ovr', for 'ovo'
+        :rtype: numpy.ndarray
+        """
+        decisions = self._binary_decisions(X)
+        if self.multiclass == 'ovr':
+            return decisions
+        # The decision values of the sub-problems are positive for their second class, the opposite of libsvm's
+        return svm_decision.ovo_scores(*svm_decision.ovo_votes(-decisions, len(self.classes_)))
+
+    def predict(self, X):
+        """
+        :return: Predicted labels
+        :rtype: numpy.ndarray
+        """
+        decisions = self._binary_decisions(X)
+        if self.multiclass == 'ovr':
+            return self.classes_[np.argmax(decisions, axis=1)]
+        votes, _ = svm_decision.ovo_votes(-decisions, len(self.classes_))
+        # argmax returns the first maximum, so ties are resolved in favour of the lowest class index, as in libsvm
+        return self.classes_[np.argmax(votes, axis=1)]
+
+
+def train_parallel_svm(X, y, C=1, kernel='rbf', gamma='auto', multiclass='ovo', n_jobs=-1, standardize=True,
+                       dim_reduction=None, save_scaler=False, save_pca=False, model_name=None, gram_cache='memory',
+                       probability='decision'):
+    """
+    Trains a ParallelSVC, whose binary sub-problems are trained in n_jobs processes.
+
+    :param kernel: One of LIBSVM_KERNELS, or the name of a kernel of KERNELS
+    :type kernel: basestring
+    :param multiclass: Decomposition in binary sub-problems: 'ovo' (one-vs-one) or 'ovr' (one-vs-rest)
+    :type multiclass: basestring
+    :param probability: How class scores are estimated: 'decision' or 'calibrated' (see PROBABILITY_MODES). Platt
+                        scaling of libsvm is not available
+    :type probability: basestring
+    :return: The classifier, the scaler and the PCA
+    :rtype: tuple
+    """
+    if probability not in ('decision', 'calibrated'):
+        raise ValueError('Unsupported probability mode for a parallel SVM: {}'.format(probability))
+    clf = ParallelSVC(C=C, kernel=kernel, gamma=gamma, multiclass=multiclass, n_jobs=n_jobs, gram_cache=gram_cache)
+    return _train_svm(X, y, clf, standardize=standardize, dim_reduction=dim_reduction, save_scaler=save_scaler,
+                      save_pca=save_pca, model_name=model_name,
+                      kernel=None if kernel in LIBSVM_KERNELS else kernel, gram_cache=gram_cache,
+                      probability=probability)
+
+
+def support_vectors(clf):
+    """
+    :return: Support vectors of a trained SVC, also for the callable and precomputed kernels (see _fit_svm), for which
+             sklearn does not store them
+    :rtype: numpy.ndarray
+    """
+    kernel = getattr(clf, 'kernel', None)
+    if kernel == 'precomputed':
+        if not hasattr(clf, 'support_features_'):
+            raise ValueError('The support vectors of the precomputed SVM are unknown, it must be trained by mlcv')
+        return clf.support_features_
+    elif callable(kernel):
+        # With callable kernels, sklearn keeps the training samples instead of the support vectors
+        return getattr(clf, '_BaseLibSVM__Xfit')[clf.support_]
+    return clf.support_vectors_
+
+
+def _svm_kernel_name(clf):
+    # Name of the kernel of KERNELS used by an SVC, if any
+    kernel = getattr(clf, 'kernel', None)
+    if kernel == 'precomputed':
+        return getattr(clf, 'kernel_name_', None)
+    for name, function in KERNELS.items():
+        if kernel is function:
+            return name
+    return None
+
+
+# Kernels whose SVMs can be evaluated by IntersectionSVMPredictor, sums of (weighted) minimums of each feature
+INTERSECTION_KERNELS = ('intersection', 'pyramid', 'pyramid_compact')
+
+
+class IntersectionSVMPredictor(object):
+    """
+    Fast evaluation of intersection and pyramid match kernel SVMs (Maji et al., Classification using intersection
+    kernel SVMs is efficient). The decision value of each binary problem is an additive function of the features,
+    sum_d h_d(x_d), with h_d(s) = sum_{v_d <= s} c * v_d + s * sum_{v_d > s} c over the support vectors v and their
+    dual coefficients c. With the support vector values of each dimension sorted, and the prefix sums of c * v and the
+    suffix sums of c precomputed, h_d is evaluated with one binary search: O(n_features * log(n_SV)) per sample instead
+    of the O(n_features * n_SV) of the kernel. The tables take O(n_features * n_SV * (n_classes - 1)) memory.
+
+    With n_bins, h_d (which is piecewise linear) is interpolated from n_bins + 1 samples between the smallest and the
+    largest support vector value of each dimension instead: O(n_features) per sample, and tables whose size does not
+    depend on the number of support vectors, at the cost of an approximation error between the samples.
+
+    It is used like the SVC (e.g. with predict_svm), whose class scores are the decision values ('decision'
+    probability mode), or the calibrated probabilities of the 'calibrated' mode.
+    """
+
+    def __init__(self, clf, n_bins=None, kernel=None, support_features=None):
+        """
+        :param clf: Trained SVC with an intersection or pyramid kernel, callable or precomputed
+        :type clf: sklearn.svm.SVC
+        :param n_bins: Number of bins of the piecewise-linear interpolation, or None for the exact evaluation
+        :type n_bins: int
+        :param kernel: Name of the kernel (one of INTERSECTION_KERNELS), required for precomputed SVMs not trained by
+                       mlcv (e.g. the best estimator of a RandomizedSearchCV on a Gram matrix)
+        :type kernel: basestring
+        :param support_features: Features of the support vectors, e.g. X_train[clf.support_], required for
+                                 precomputed SVMs not trained by mlcv
+        :type support_features: numpy.ndarray
+        """
+        if kernel is None:
+            kernel = _svm_kernel_name(clf)
+        if kernel not in INTERSECTION_KERNELS:
+            raise ValueError('Only intersection and pyramid kernel SVMs can be evaluated, not {} (pass kernel and '
+                             'support_features for precomputed SVMs not trained by mlcv)'.format(kernel))
+        self.classes_ = clf.classes_
+        self.intercept_ = clf.intercept_
+        self.n_bins = n_bins
+        if probability_mode(clf) == 'calibrated':
+            self.probability_mode_ = 'calibrated'
+            self.calibrator_ = clf.calibrator_
+        else:
+            self.probability_mode_ = 'decision'
+
+        features = support_vectors(clf) if support_features is None else support_features
+        if features.shape[0] != len(clf.support_):
+            raise ValueError('{} support features do not match the {} support vectors'.format(features.shape[0],
+                                                                                              len(clf.support_)))
+        features = np.asarray(features.toarray() if hasattr(features, 'toarray') else features, dtype=np.float64)
+        # min(w * a, w * b) = w * min(a, b), so the pyramid kernel is an intersection kernel of the weighted features.
+        # Compact pyramids are expanded to the full ones, with the weight of each level applied to its histograms
+        self.level_weights_ = kernels._level_weights(len(settings.pyramid_levels)) \
+            if kernel == 'pyramid_compact' else None
+        self.feature_weights_ = kernels._pyramid_weights(features.shape[1]) if kernel == 'pyramid' else None
+        features = self._weigh(features)
+
+        # The support vectors of class i contribute to the n_classes - 1 problems of i, each with a row of dual_coef_
+        starts = np.concatenate([[0], np.cumsum(clf.n_support_)])
+        self.tables_ = [self._class_tables(features[starts[c]:starts[c + 1]],
+                                           clf.dual_coef_[:, starts[c]:starts[c + 1]].T)
+                        for c in range(len(self.classes_))]
+
+    def _class_tables(self, values, coefficients):
+        n_values, n_features = values.shape
+        dimensions = np.arange(n_features)
+        order = np.argsort(values, axis=0, kind='mergesort')
+        sorted_values = values[order, dimensions]
+        sorted_coefficients = coefficients[order]
+
+        # Prefix sums of c * v and of c, with a leading zero, with dimensions (n_features, n_values + 1, n_outputs)
+        prefix = np.zeros((n_features, n_values + 1, coefficients.shape[1]))
+        prefix[:, 1:] = np.cumsum(sorted_coefficients * sorted_values[:, :, None], axis=0).transpose(1, 0, 2)
+        cumulative = np.zeros_like(prefix)
+        cumulative[:, 1:] = np.cumsum(sorted_coefficients, axis=0).transpose(1, 0, 2)
+        total = cumulative[:, -1:]
+        tables = {
+            # Complex numbers are ordered by their real part first, so a single binary search over the dimension
+            # index plus the value (as imaginary part) searches each value in the sorted values of its dimension
+            'keys': (dimensions[:, None] + 1j * sorted_values.T).ravel(),
+            'prefix': prefix.reshape(-1, coefficients.shape[1]),
+            'suffix': (total - cumulative).reshape(-1, coefficients.shape[1]),
+            'total': total[0, 0]
+        }
+        if self.n_bins is None:
+            return tables
+
+        # Samples of h_d at n_bins + 1 points between the extreme values of each dimension, beyond which it is linear
+        low = sorted_values[0] if n_values else np.zeros(n_features)
+        high = sorted_values[-1] if n_values else np.zeros(n_features)
+        step = np.where(high > low, (high - low) / self.n_bins, 1.0)
+        grid = low[:, None] + step[:, None] * np.arange(self.n_bins + 1)
+        samples = self._exact_sums(grid.T, tables, reduce=False).transpose(1, 0, 2)
+        return {'low': low, 'step': step, 'samples': samples.reshape(-1, coefficients.shape[1]),
+                'total': tables['total']}
+
+    @staticmethod
+    def _exact_sums(X, tables, reduce=True):
+        # sum_d h_d(x_d) of each sample and output, or each h_d(x_d) with dimensions (n_samples, n_features, n_outputs)
+        n_features = X.shape[1]
+        dimensions = np.arange(n_features)
+        rank = np.searchsorted(tables['keys'], (dimensions + 1j * X).ravel(), side='right').reshape(X.shape)
+        # The rank counts the values of the previous dimensions, whose tables have one more row each
+        rows = rank + dimensions
+        if reduce:
+            return tables['prefix'][rows].sum(axis=1) + np.einsum('nd,ndk->nk', X, tables['suffix'][rows])
+        return tables['prefix'][rows] + X[:, :, None] * tables['suffix'][rows]
+
+    def _interpolated_sums(self, X, tables):
+        n_features = X.shape[1]
+        position = (X - tables['low']) / tables['step']
+        below = position < 0
+        position = np.clip(position, 0, self.n_bins)
+        bins = np.minimum(np.floor(position), self.n_bins - 1).astype(np.int64)
+        fraction = (position - bins)[:, :, None]
+        rows = np.arange(n_features) * (self.n_bins + 1) + bins
+        values = tables['samples'][rows] * (1 - fraction) + tables['samples'][rows + 1] * fraction
+        # Below the smallest support vector value, h_d(s) = s * sum c
+        values = np.where(below[:, :, None], X[:, :, None] * tables['total'], values)
+        return values.sum(axis=1)
+
+    def _pair_decisions(self, X):
+        # Decision values of the pairs of classes (i, j) in libsvm's order, positive for i
+        if self.n_bins is None:
+            sums = [self._exact_sums(X, tables) for tables in self.tables_]
+        else:
+            sums = [self._interpolated_sums(X, tables) for tables in self.tables_]
+
+        n_classes = len(self.classes_)
+        if n_classes == 2:
+            # sklearn flips the sign of binary problems, whose decision values are positive for the second class
+            return -(sums[0] + sums[1] + self.intercept_)
+        decisions = [sums[i][:, j - 1] + sums[j][:, i] for i in range(n_classes) for j in range(i + 1, n_classes)]
+        return np.column_stack(decisions) + self.intercept_
+
+    def _weigh(self, X):
+        if self.level_weights_ is not None:
+            return pyramid.expand_pyramid(X, level_weights=self.level_weights_)
+        if self.feature_weights_ is not None:
+            return X * self.feature_weights_
+        return X
+
+    def _decisions(self, X):
+        X = self._weigh(np.asarray(X.toarray() if hasattr(X, 'toarray') else X, dtype=np.float64))
+        # Samples are processed in chunks, whose temporaries of dimensions (n_samples, n_features, n_outputs) are
+        # bounded by the memory budget of the kernels
+        n_outputs = max(len(self.classes_) - 1, 1)
+        chunk_size = max(1, kernels.MEMORY_BUDGET // (4 * 8 * X.shape[1] * n_outputs))
+        return np.concatenate([self._pair_decisions(X[i:i + chunk_size])
+                               for i in range(0, max(X.shape[0], 1), chunk_size)])
+
+    def decision_function(self, X):
+        """
+        :param X: Samples matrix with dimensions (n_samples, n_features)
+        :type X: numpy.ndarray
+        :return: Decision values, as the ones of the SVC (with decision_function_shape='ovr')
+        :rtype: numpy.ndarray
+        """
+        decisions = self._decisions(X)
+        if len(self.classes_) == 2:
+            return -decisions[:, 0]
+        return svm_decision.ovo_scores(*svm_decision.ovo_votes(decisions, len(self.classes_)))
+
+    def predict(self, X):
+        """
+        :param X: Samples matrix with dimensions (n_samples, n_features)
+        :type X: numpy.ndarray
+        :return: Predicted labels, by the voting of libsvm
+        :rtype: numpy.ndarray
+        """
+        votes, _ = svm_decision.ovo_votes(self._decisions(X), len(self.classes_))
+        return self.classes_[np.argmax(votes, axis=1)]
+
+
+class FoldedLinearModel(object):
+    """
+    Linear classifier with the PCA and the standardization folded into its weights (see fold_linear_model), so that
+    the class scores of a batch of samples are a single matrix product.
+    """
+
+    def __init__(self, classes, weights, intercept, decision='ovr'):
+        """
+        :param classes: Class labels
+        :type classes: numpy.ndarray
+        :param weights: Weights with dimensions (n_features, n_outputs)
+        :type weights: numpy.ndarray
+        :param intercept: Bias of each output
+        :type intercept: numpy.ndarray
+        :param decision: Outputs of the weights: 'ovr' (one per class, or a single one for binary problems) or 'ovo'
+                         (one per pair of classes in libsvm's order, positive for the first class)
+        :type decision: basestring
+        """
+        self.classes_ = classes
+        # Not named coef_, which sklearn stores with the transposed dimensions (n_outputs, n_features)
+        self.weights_ = weights
+        self.intercept_ = intercept
+        self.decision = decision
+        self.probability_mode_ = 'decision'
+
+    def _outputs(self, X):
+        outputs = np.dot(X, self.weights_)
+        outputs += self.intercept_
+        return outputs
+
+    def decision_function(self, X):
+        """
+        :param X: Samples matrix with dimensions (n_samples, n_features), before the PCA and the standardization
+        :type X: numpy.ndarray
+        :return: Decision values, as the ones of the linear classifier (with decision_function_shape='ovr' for SVC)
+        :rtype: numpy.ndarray
+        """
+        outputs = self._outputs(X)
+        if outputs.shape[1] == 1:
+            return outputs[:, 0]
+        if self.decision == 'ovo':
+            return svm_decision.ovo_scores(*svm_decision.ovo_votes(outputs, len(self.classes_)))
+        return outputs
+
+    def predict(self, X):
+        """
+        :param X: Samples matrix with dimensions (n_samples, n_features), before the PCA and the standardization
+        :type X: numpy.ndarray
+        :return: Predicted labels
+        :rtype: numpy.ndarray
+        """
+        outputs = self._outputs(X)
+        if outputs.shape[1] == 1:
+            return self.classes_[np.asarray(outputs[:, 0] > 0, dtype=np.int64)]
+        if self.decision == 'ovo':
+            votes, _ = svm_decision.ovo_votes(outputs, len(self.classes_))
+            return self.classes_[np.argmax(votes, axis=1)]
+        return self.classes_[np.argmax(outputs, axis=1)]
+
+
+def fold_linear_model(clf, std_scaler=None, pca=None, dtype=np.float64, model_name=None):
+    """
+    Folds the PCA projection and the standardization applied by predict_svm into the weights of a linear classifier:
+    with Z = ((X - m) A - mu) / sigma, Z W + b = X (A W / sigma) + (b - (m A + mu) W / sigma), where A is the PCA
+    projection (whitened if the PCA is). The folded model is used like the original one, without scaler or PCA, e.g.
+    predict_svm(X, folded_model), and its scores are the decision values of the classifier. They match the ones of the
+    unfolded pipeline up to the float32 rounding of the PCA output that predict_svm applies.
+
+    :param clf: Trained linear classifier: LinearSVC, SGDClassifier, LogisticRegression or SVC with a linear kernel
+    :type clf: sklearn.base.BaseEstimator
+    :param std_scaler: Scaler applied after the PCA, if any
+    :type std_scaler: sklearn.preprocessing.StandardScaler
+    :param pca: PCA applied to the samples, if any
+    :type pca: sklearn.decomposition.PCA
+    :param dtype: Data type of the folded weights, e.g. numpy.float32 to avoid converting float32 descriptors
+    :type dtype: numpy.dtype
+    :param model_name: If given, the folded model is stored with this name
+    :type model_name: basestring
+    :return: The folded model
+    :rtype: FoldedLinearModel
+    """
+    if not hasattr(clf, 'coef_') or (hasattr(clf, 'kernel') and clf.kernel != 'linear'):
+        raise ValueError('Cannot fold a {}, only linear classifiers are supported (train them with '
+                         'probability=\'decision\' or \'calibrated\')'.format(type(clf).__name__))
+    # SVC has one output per pair of classes, and the other classifiers one per class
+    decision = 'ovo' if hasattr(clf, 'n_support_') else 'ovr'
+    weights = np.asarray(clf.coef_, dtype=np.float64).T
+    intercept = np.asarray(clf.intercept_, dtype=np.float64).ravel()
+
+    if std_scaler is not None:
+        if std_scaler.with_std:
+            weights = weights / std_scaler.scale_[:, None]
+        if std_scaler.with_mean:
+            intercept = intercept - np.dot(std_scaler.mean_, weights)
+
+    if pca is not None:
+        components = pca.components_
+        if pca.whiten:
+            components = components / np.sqrt(pca.explained_variance_)[:, None]
+        weights = np.dot(components.T, weights)
+        intercept = intercept - np.dot(pca.mean_, weights)
+
+    folded = FoldedLinearModel(clf.classes_, np.asarray(weights, dtype=dtype), np.asarray(intercept, dtype=dtype),
+                               decision=decision)
+    if probability_mode(clf) == 'calibrated':
+        folded.probability_mode_ = 'calibrated'
+        folded.calibrator_ = clf.calibrator_
+
+    if model_name is not None:
+        io.save_object(folded, model_name)
+    return folded
+
+
+def _predict_chunk(X, svm, std_scaler, pca, probability):
     # Apply PCA if available
     if pca is not None:
         X = pca.transform(X)
@@ -257,9 +1111,128 @@ def predict_svm(X, svm, std_scaler=None, pca=None, probability=True):
     else:
         X_std = std_scaler.transform(X)
 
+    # Precomputed-kernel models only need the kernel between the samples and the support vectors
+    if getattr(svm, 'kernel', None) == 'precomputed' and hasattr(svm, 'support_features_'):
+        X_std = _precomputed_test_gram(X_std, svm)
+
     # Predict the labels
-    if probability:
+    if not probability:
+        return svm.predict(X_std)
+
+    mode = probability_mode(svm)
+    if mode == 'platt':
         return svm.predict_proba(X_std)
+    scores = _decision_scores(svm, X_std)
+    if mode == 'calibrated':
+        return svm.calibrator_.predict_proba(scores)
+    return scores
+
+
+def predict_svm(X, svm, std_scaler=None, pca=None, probability=True, n_jobs=1, chunk_size=None,
+                backend='threading'):
+    """
+    Predicts the labels of the samples, or their class scores, which are estimated according to the probability mode
+    of the classifier (see PROBABILITY_MODES): probabilities for 'platt' and 'calibrated', decision values for
+    'decision'. Scores have one column per class in svm.classes_ in every mode, so the scores of the descriptors of
+    an image can be aggregated by summing them up.
+
+    Large inputs can be split in chunks of rows predicted in parallel: libsvm releases the GIL, so threads scale with
+    the number of cores. With a process backend, joblib memory-maps the large arrays of the model, which is shared by
+    the workers instead of copied.
+
+    :param X: Samples matrix with dimensions (n_samples, n_features)
+    :type X: numpy.ndarray
+    :param svm: Trained classifier
+    :type svm: sklearn.base.BaseEstimator
+    :param std_scaler: Scaler applied after the PCA, if any
+    :type std_scaler: sklearn.preprocessing.StandardScaler
+    :param pca: PCA applied to the samples, if any
+    :type pca: sklearn.decomposition.PCA
+    :param probability: Return the class scores instead of the labels
+    :type probability: bool
+    :param n_jobs: Number of parallel jobs (-1 for all the cores)
+    :type n_jobs: int
+    :param chunk_size: Number of rows of each chunk. If None, the rows are split in 4 chunks per job
+    :type chunk_size: int
+    :param backend: joblib backend: 'threading', or a process backend such as 'loky' or 'multiprocessing'
+    :type backend: basestring
+    :return: Class scores with dimensions (n_samples, n_classes), or labels
+    :rtype: numpy.ndarray
+    """
+    n_samples = X.shape[0]
+    n_jobs = joblib.cpu_count() if n_jobs is None or n_jobs < 0 else n_jobs
+    if chunk_size is None:
+        chunk_size = n_samples if n_jobs <= 1 else -(-n_samples // (4 * n_jobs))
+    chunk_size = max(chunk_size, 1)
+    if n_samples <= chunk_size:
+        return _predict_chunk(X, svm, std_scaler, pca, probability)
+
+    results = joblib.Parallel(n_jobs=n_jobs, backend=backend)(
+        joblib.delayed(_predict_chunk)(X[i:i + chunk_size], svm, std_scaler, pca, probability)
+        for i in range(0, n_samples, chunk_size)
+    )
+    # Results are returned in the order of the chunks
+    return np.concatenate(results)
+
+
+def image_offsets(descriptors_indices, n_images=None):
+    """
+    Computes the offsets of the descriptors of each image, for descriptors grouped by image (as returned by the
+    feature extraction functions)
+
+    :param descriptors_indices: Image index of each descriptor, in non-decreasing order
+    :type descriptors_indices: numpy.ndarray
+    :param n_images: Number of images (the largest index plus one by default)
+    :type n_images: int
+    :return: Index of the first descriptor of each image, with length n_images
+    :rtype: numpy.ndarray
+    """
+    descriptors_indices = np.asarray(descriptors_indices)
+    if n_images is None:
+        n_images = descriptors_indices.max() + 1
+    return np.searchsorted(descriptors_indices, np.arange(n_images))
+
+
+def predict_svm_batch(X, offsets, svm, std_scaler=None, pca=None, probability=True, n_jobs=1, chunk_size=None,
+                      backend='threading'):
+    """
+    Predicts the class scores of a batch of images from all their descriptors at once: the PCA, the scaler and the
+    classifier are applied once to the whole descriptors matrix, and the scores of the descriptors of each image are
+    summed up with a segment sum.
+
+    :param X: Descriptors matrix of all the images, grouped by image, with dimensions (n_descriptors, n_features)
+    :type X: numpy.ndarray
+    :param offsets: Index of the first descriptor of each image (see image_offsets). Images without descriptors
+                    (repeated offsets) get zero scores
+    :type offsets: numpy.ndarray
+    :param svm: Trained classifier
+    :type svm: sklearn.base.BaseEstimator
+    :param std_scaler: Scaler applied after the PCA, if any
+    :type std_scaler: sklearn.preprocessing.StandardScaler
+    :param pca: PCA applied to the descriptors, if any
+    :type pca: sklearn.decomposition.PCA
+    :param probability: Aggregate the class scores (see predict_svm) instead of the votes of the predicted labels
+    :type probability: bool
+    :param n_jobs: Number of parallel jobs of the prediction (see predict_svm)
+    :type n_jobs: int
+    :param chunk_size: Number of rows of each chunk of the prediction (see predict_svm)
+    :type chunk_size: int
+    :param backend: joblib backend of the prediction (see predict_svm)
+    :type backend: basestring
+    :return: Aggregated scores of each image with dimensions (n_images, n_classes), with columns in svm.classes_
+    :rtype: numpy.ndarray
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    parallel = {'n_jobs': n_jobs, 'chunk_size': chunk_size, 'backend': backend}
+    if probability:
+        scores = predict_svm(X, svm, std_scaler=std_scaler, pca=pca, probability=True, **parallel)
     else:
-        return svm.predict(X_std)
+        labels = predict_svm(X, svm, std_scaler=std_scaler, pca=pca, probability=False, **parallel)
+        scores = (labels[:, None] == svm.classes_[None, :]).astype(np.float64)
 
+    # Empty images are left out of the segment sum, which would otherwise return the score of their next descriptor
+    lengths = np.diff(np.append(offsets, scores.shape[0]))
+    aggregated = np.zeros((offsets.shape[0], scores.shape[1]), dtype=scores.dtype)
+    if np.any(lengths > 0):
+        aggregated[lengths > 0] = np.add.reduceat(scores, offsets[lengths > 0], axis=0)
+    return aggregated
@@ -0,0 +1,330 @@
+"""
+Export of trained BoVW and Fisher pipelines as flat .npy arrays plus a small JSON manifest, and a predictor that runs
+them with NumPy and the mlcv.kernels functions only: loading it neither imports sklearn nor unpickles any object.
+"""
+import json
+import os
+
+import numpy as np
+
+import mlcv.input_output as io
+import mlcv.kernels as kernels
+import mlcv.pyramid as pyramid
+import mlcv.settings as settings
+import mlcv.svm_decision as svm_decision
+
+MANIFEST = 'manifest.json'
+FORMAT_VERSION = 1
+
+# Kernels of mlcv.kernels whose features depend on the pyramid settings
+PYRAMID_KERNELS = ('pyramid_kernel', 'compact_pyramid_kernel')
+
+# Number of descriptors assigned to the visual words at once
+ASSIGNMENT_CHUNK = 4096
+
+
+def export_path(name):
+    """
+    :return: Directory of an exported pipeline
+    :rtype: basestring
+    """
+    return os.path.join(io.MODELS_PATH, name)
+
+
+def _ovo_coefficients(clf):
+    # Dual coefficients of each pair of classes (i, j), in libsvm's order, as a (n_support_vectors, n_pairs) matrix,
+    # so that the decision values of all the pairs are a single matrix product. libsvm stores the coefficient of a
+    # support vector of class i in row j - 1 of dual_coef_ and the one of a support vector of class j in row i
+    n_classes = len(clf.classes_)
+    if n_classes == 2:
+        # sklearn flips the sign of the binary problem, whose decision is positive for the second class
+        return -clf.dual_coef_.T, -clf.intercept_
+
+    starts = np.concatenate([[0], np.cumsum(clf.n_support_)])
+    coefficients = np.zeros((clf.dual_coef_.shape[1], n_classes * (n_classes - 1) // 2))
+    pair = 0
+    for i in range(n_classes):
+        for j in range(i + 1, n_classes):
+            coefficients[starts[i]:starts[i + 1], pair] = clf.dual_coef_[j - 1, starts[i]:starts[i + 1]]
+            coefficients[starts[j]:starts[j + 1], pair] = clf.dual_coef_[i, starts[j]:starts[j + 1]]
+            pair += 1
+    return coefficients, clf.intercept_
+
+
+def _svc_arrays(clf):
+    # Kernels of mlcv.kernels are either callables of the SVC or precomputed Gram matrices (see classification)
+    import mlcv.classification as classification
+
+    coefficients, intercept = _ovo_coefficients(clf)
+    config = {'decision': 'ovo'}
+    if clf.kernel == 'precomputed':
+        support_vectors = classification.support_vectors(clf)
+        config['kernel'] = classification.KERNELS[clf.kernel_name_].__name__
+    elif callable(clf.kernel):
+        if getattr(kernels, clf.kernel.__name__, None) is not clf.kernel:
+            raise ValueError('Only the kernels of mlcv.kernels can be exported')
+        support_vectors = classification.support_vectors(clf)
+        config['kernel'] = clf.kernel.__name__
+    elif clf.kernel == 'linear':
+        # The support vectors are folded into the weights of the linear decision function of each pair
+        return config, {'weights': np.dot(clf.support_vectors_.T, coefficients), 'intercept': intercept}
+    elif clf.kernel in svm_decision.LIBSVM_KERNELS:
+        support_vectors = clf.support_vectors_
+        config.update({'kernel': clf.kernel, 'gamma': float(getattr(clf, '_gamma', clf.gamma)),
+                       'degree': int(clf.degree), 'coef0': float(clf.coef0)})
+    else:
+        raise ValueError('Unknown SVM kernel: {}'.format(clf.kernel))
+
+    return config, {'support_vectors': np.asarray(support_vectors), 'dual_coef': coefficients,
+                    'intercept': intercept}
+
+
+def _linear_arrays(weights, intercept, decision):
+    # Weights with one column per output. A single output is positive for the second class, so it is exported as the
+    # one-vs-rest decision values of both classes
+    weights, intercept = np.asarray(weights), np.ravel(intercept)
+    if weights.shape[1] == 1:
+        weights, intercept, decision = np.hstack([-weights, weights]), np.concatenate([-intercept, intercept]), 'ovr'
+    return {'decision': decision}, {'weights': weights, 'intercept': intercept}
+
+
+def _classifier_arrays(clf):
+    import mlcv.classification as classification
+
+    if isinstance(clf, classification.FoldedLinearModel):
+        # The folded weights already have one column per output: per class (ovr) or per pair of classes (ovo)
+        config, arrays = _linear_arrays(clf.weights_, clf.intercept_, clf.decision)
+    elif hasattr(clf, 'dual_coef_') and hasattr(clf, 'n_support_'):
+        config, arrays = _svc_arrays(clf)
+    elif hasattr(clf, 'coef_'):
+        # Linear models (LinearSVC, SGDClassifier, LogisticRegression): one-vs-rest decision values
+        config, arrays = _linear_arrays(clf.coef_.T, clf.intercept_, 'ovr')
+    else:
+        raise ValueError('Cannot export a {}, only SVC and linear classifiers are supported (train them with '
+                         'probability=\'decision\')'.format(type(clf).__name__))
+
+    arrays['classes'] = np.asarray(clf.classes_.tolist())
+    return config, arrays
+
+
+def export_pipeline(name, svm, codebook=None, pca=None, std_scaler=None, normalization=None, spatial_pyramid=False):
+    """
+    Exports a trained pipeline as .npy arrays plus a manifest in export_path(name), to be loaded by ExportedPipeline.
+
+    The class scores of the exported classifier are its decision values (as in the 'decision' probability mode),
+    whatever the probability mode it was trained with; the predicted labels are the ones of the classifier.
+
+    :param name: Name of the exported pipeline
+    :type name: basestring
+    :param svm: Trained classifier: an SVC (libsvm kernels, or kernels of mlcv.kernels, callable or precomputed), a
+                linear classifier or a classification.FoldedLinearModel (exported without PCA nor scaler, which are
+                folded into its weights)
+    :type svm: sklearn.base.BaseEstimator
+    :param codebook: Codebook of the BoVW pipelines (None for Fisher pipelines, which are fed Fisher vectors)
+    :type codebook: sklearn.cluster.MiniBatchKMeans
+    :param pca: PCA applied to the image representations, if any
+    :type pca: sklearn.decomposition.PCA
+    :param std_scaler: Scaler applied after the PCA, if any
+    :type std_scaler: sklearn.preprocessing.StandardScaler
+    :param normalization: Normalization of the image representations: None, 'l1', 'l2' or 'power'
+    :type normalization: basestring
+    :param spatial_pyramid: Whether the BoVW representations are spatial pyramids
+    :type spatial_pyramid: bool
+    :return: Directory of the exported pipeline
+    :rtype: basestring
+    """
+    config, arrays = _classifier_arrays(svm)
+    config.update({
+        'format_version': FORMAT_VERSION,
+        'normalization': normalization,
+        'spatial_pyramid': bool(spatial_pyramid),
+        'pyramid_levels': [list(level) for level in settings.pyramid_levels],
+        'keypoints_shape': [int(v) for v in settings.get_keypoints_shape()]
+    })
+
+    if codebook is not None:
+        arrays['centroids'] = np.asarray(getattr(codebook, 'cluster_centers_', codebook))
+    if pca is not None:
+        arrays['pca_mean'] = pca.mean_
+        arrays['pca_components'] = pca.components_
+        if pca.whiten:
+            arrays['pca_scale'] = np.sqrt(pca.explained_variance_)
+    if std_scaler is not None:
+        if std_scaler.with_mean:
+            arrays['scaler_mean'] = std_scaler.mean_
+        if std_scaler.with_std:
+            arrays['scaler_scale'] = std_scaler.scale_
+
+    directory = export_path(name)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for array_name, array in arrays.items():
+        np.save(os.path.join(directory, '{}.npy'.format(array_name)), array)
+    config['arrays'] = sorted(arrays.keys())
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+
+    return directory
+
+
+class ExportedPipeline(object):
+    """
+    Predictor of a pipeline exported by export_pipeline. The arrays are memory-mapped, so loading it only reads the
+    manifest, and prediction is a few matrix products: visual words assignment, PCA, kernel with the support vectors
+    and dual coefficients.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: Name of the exported pipeline
+        :type name: basestring
+        """
+        directory = export_path(name)
+        with open(os.path.join(directory, MANIFEST), 'r') as f:
+            self.manifest = json.load(f)
+        if self.manifest['format_version'] != FORMAT_VERSION:
+            raise ValueError('Unsupported export format: {}'.format(self.manifest['format_version']))
+
+        self.arrays = dict((array_name, np.load(os.path.join(directory, '{}.npy'.format(array_name)), mmap_mode='r'))
+                           for array_name in self.manifest['arrays'])
+        self.classes_ = np.asarray(self.arrays['classes'])
+
+        # Pyramids are compact (the finest level only) for the compact pyramid kernel, which expands them
+        self.compact_ = self.manifest.get('kernel') == 'compact_pyramid_kernel'
+        if self.manifest['spatial_pyramid'] or self.manifest.get('kernel') in PYRAMID_KERNELS:
+            # The pyramid layout is taken from the settings, which must be the ones of the training
+            if ([list(level) for level in settings.pyramid_levels] != self.manifest['pyramid_levels'] or
+                    [int(v) for v in settings.get_keypoints_shape()] != self.manifest['keypoints_shape']):
+                raise ValueError('The pyramid settings differ from the ones of the exported pipeline')
+
+    def assign_words(self, descriptors):
+        """
+        :param descriptors: Descriptors matrix with dimensions (n_descriptors, n_features)
+        :type descriptors: numpy.ndarray
+        :return: Closest visual word of each descriptor
+        :rtype: numpy.ndarray
+        """
+        centroids = np.asarray(self.arrays['centroids'], dtype=np.float64)
+        squared_norms = np.sum(centroids ** 2, axis=1)
+        words = np.empty(descriptors.shape[0], dtype=np.int64)
+        for i in range(0, descriptors.shape[0], ASSIGNMENT_CHUNK):
+            chunk = np.asarray(descriptors[i:i + ASSIGNMENT_CHUNK], dtype=np.float64)
+            # The squared norm of the descriptors does not change which centroid is the closest one
+            words[i:i + ASSIGNMENT_CHUNK] = np.argmin(squared_norms - 2 * np.dot(chunk, centroids.T), axis=1)
+        return words
+
+    def visual_words(self, descriptors, descriptors_indices):
+        """
+        Computes the BoVW representation of each image (histograms or spatial pyramids), as bovw.visual_words
+
+        :param descriptors: Descriptors matrix of all the images with dimensions (n_descriptors, n_features)
+        :type descriptors: numpy.ndarray
+        :param descriptors_indices: Image index of each descriptor
+        :type descriptors_indices: numpy.ndarray
+        :return: Representations with dimensions (n_images, n_columns)
+        :rtype: numpy.ndarray
+        """
+        descriptors_indices = np.asarray(descriptors_indices)
+        words = self.assign_words(descriptors)
+        k = self.arrays['centroids'].shape[0]
+        n_images = descriptors_indices.max() + 1
+
+        if self.manifest['spatial_pyramid']:
+            layout = pyramid.pyramid_layout()
+            if self.compact_:
+                layout = [layout[pyramid.finest_level(layout)]]
+            columns, n_columns = pyramid.pyramid_columns(words, descriptors_indices, layout, k)
+            rows = np.tile(descriptors_indices, len(columns))
+            columns = np.concatenate(columns)
+        else:
+            rows, columns, n_columns = descriptors_indices, words, k
+
+        counts = np.bincount(rows * n_columns + columns, minlength=n_images * n_columns)
+        return np.asarray(counts, dtype=np.float64).reshape(n_images, n_columns)
+
+    def _transform(self, X):
+        # Normalization, PCA and standardization, as in bovw and classification.predict_svm
+        X = np.asarray(X, dtype=np.float64)
+        normalization = self.manifest['normalization']
+        if normalization == 'l1':
+            X = X / np.sum(np.abs(X), axis=1, keepdims=True)
+        elif normalization == 'l2':
+            X = X / np.linalg.norm(X, axis=1, keepdims=True)
+        elif normalization == 'power':
+            X = np.sign(X) * np.sqrt(np.abs(X))
+
+        if 'pca_components' in self.arrays:
+            X = np.dot(X - self.arrays['pca_mean'], self.arrays['pca_components'].T)
+            if 'pca_scale' in self.arrays:
+                X /= self.arrays['pca_scale']
+            X = np.float32(X)
+        if 'scaler_mean' in self.arrays:
+            X = X - self.arrays['scaler_mean']
+        if 'scaler_scale' in self.arrays:
+            X = X / self.arrays['scaler_scale']
+        return X
+
+    def _kernel(self, X):
+        support_vectors = self.arrays['support_vectors']
+        kernel = self.manifest['kernel']
+        if kernel not in svm_decision.LIBSVM_KERNELS:
+            return getattr(kernels, kernel)(X, support_vectors)
+
+        X = np.asarray(X, dtype=np.float64)
+        support_vectors = np.asarray(support_vectors, dtype=np.float64)
+        gamma = self.manifest['gamma']
+        products = np.dot(X, support_vectors.T)
+        if kernel == 'rbf':
+            distances = np.sum(X ** 2, axis=1)[:, None] - 2 * products + np.sum(support_vectors ** 2, axis=1)[None, :]
+            return np.exp(-gamma * np.maximum(distances, 0))
+        elif kernel == 'poly':
+            return (gamma * products + self.manifest['coef0']) ** self.manifest['degree']
+        return np.tanh(gamma * products + self.manifest['coef0'])
+
+    def _decisions(self, X):
+        # Decision values of the pairs of classes (ovo) or of the classes (ovr)
+        X = self._transform(X)
+        if 'weights' in self.arrays:
+            return np.dot(X, self.arrays['weights']) + self.arrays['intercept']
+        return np.dot(self._kernel(X), self.arrays['dual_coef']) + self.arrays['intercept']
+
+    def decision_function(self, X):
+        """
+        :param X: Image representations (visual words, or Fisher vectors for Fisher pipelines), before normalization
+        :type X: numpy.ndarray
+        :return: Class scores with dimensions (n_images, n_classes), as classification.predict_svm in the 'decision'
+                 probability mode
+        :rtype: numpy.ndarray
+        """
+        decisions = self._decisions(X)
+        if self.manifest['decision'] == 'ovr':
+            return decisions
+        if len(self.classes_) == 2:
+            return np.column_stack([decisions[:, 0], -decisions[:, 0]])
+        return svm_decision.ovo_scores(*svm_decision.ovo_votes(decisions, len(self.classes_)))
+
+    def predict(self, X):
+        """
+        :param X: Image representations (visual words, or Fisher vectors for Fisher pipelines), before normalization
+        :type X: numpy.ndarray
+        :return: Predicted labels
+        :rtype: numpy.ndarray
+        """
+        decisions = self._decisions(X)
+        if self.manifest['decision'] == 'ovr':
+            return self.classes_[np.argmax(decisions, axis=1)]
+        votes, _ = svm_decision.ovo_votes(decisions, len(self.classes_))
+        return self.classes_[np.argmax(votes, axis=1)]
+
+    def predict_descriptors(self, descriptors, descriptors_indices):
+        """
+        Predicts the labels of the images of a BoVW pipeline from their descriptors
+
+        :param descriptors: Descriptors matrix of all the images with dimensions (n_descriptors, n_features)
+        :type descriptors: numpy.ndarray
+        :param descriptors_indices: Image index of each descriptor
+        :type descriptors_indices: numpy.ndarray
+        :return: Predicted label of each image
+        :rtype: numpy.ndarray
+        """
+        return self.predict(self.visual_words(descriptors, descriptors_indices))
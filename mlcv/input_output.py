@@ -1,6 +1,8 @@
+import hashlib
 import os
 import sys
 import numpy as np
+import scipy.sparse as sp
 
 try:
     import cPickle as pickle
@@ -95,6 +97,14 @@ def load_grayscale_image(image):
     return ima
 
 
+def _storage_folder(ignore):
+    # The ignore folder is not part of the repository, so it is created on the first write
+    folder = IGNORE_PATH if ignore else MODELS_PATH
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    return folder
+
+
 def save_object(obj, model_name, ignore=False):
     """
     Saves an object to disk
@@ -106,7 +116,7 @@ def save_object(obj, model_name, ignore=False):
     :param ignore: Store the object in the ignore folder
     :type ignore: bool
     """
-    folder = IGNORE_PATH if ignore else MODELS_PATH
+    folder = _storage_folder(ignore)
     filepath = os.path.join(folder, '{}.pickle'.format(model_name))
     try:
         import joblib
@@ -139,6 +149,92 @@ def load_object(model_name, ignore=False):
     return obj
 
 
+def array_path(name, ignore=False, create_folder=False):
+    """
+    :param name: Name of the array
+    :type name: basestring
+    :param ignore: The array is stored in the ignore folder
+    :type ignore: bool
+    :param create_folder: Create the folder if it does not exist, for arrays written in place
+    :type create_folder: bool
+
+    :return: Path of the .npy file of an array saved with save_array (or written in place, e.g. by the kernels)
+    :rtype: basestring
+    """
+    folder = _storage_folder(ignore) if create_folder else IGNORE_PATH if ignore else MODELS_PATH
+    return os.path.join(folder, '{}.npy'.format(name))
+
+
+def save_array(array, name, ignore=False):
+    """
+    Saves an array to disk as a .npy file, so that it can be memory-mapped when loaded
+
+    :param array: The array to be saved
+    :type array: numpy.ndarray
+    :param name: Name of the array to be saved
+    :type name: basestring
+    :param ignore: Store the array in the ignore folder
+    :type ignore: bool
+    """
+    np.save(array_path(name, ignore=ignore, create_folder=True), array)
+
+
+def load_array(name, mmap_mode='r', ignore=False):
+    """
+    Loads an array stored with save_array
+
+    :param name: Name of the array to be loaded
+    :type name: basestring
+    :param mmap_mode: Memory-map mode used to open the file (None to load it in memory)
+    :type mmap_mode: basestring
+    :param ignore: Load the array from the ignore folder
+    :type ignore: bool
+    :return: The loaded array
+    :rtype: numpy.ndarray, numpy.memmap
+    """
+    return np.load(array_path(name, ignore=ignore), mmap_mode=mmap_mode)
+
+
+def _update_fingerprint(digest, obj):
+    if isinstance(obj, np.ndarray) and obj.dtype != object:
+        digest.update('{}{}'.format(obj.dtype.str, obj.shape).encode('utf-8'))
+        # Hash by blocks of rows to avoid copying the whole array when it is not contiguous
+        rows = obj.reshape(obj.shape[0], -1) if obj.ndim > 1 else obj.reshape(1, -1)
+        step = max(1, 2 ** 24 // max(rows.shape[1] * rows.itemsize, 1))
+        for i in range(0, rows.shape[0], step):
+            digest.update(np.ascontiguousarray(rows[i:i + step]).view(np.uint8))
+    elif sp.issparse(obj):
+        obj = sp.csr_matrix(obj)
+        digest.update('{}{}'.format(type(obj).__name__, obj.shape).encode('utf-8'))
+        for array in (obj.data, obj.indices, obj.indptr):
+            _update_fingerprint(digest, array)
+    elif isinstance(obj, dict):
+        for key in sorted(obj.keys(), key=repr):
+            _update_fingerprint(digest, key)
+            _update_fingerprint(digest, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        digest.update('{}{}'.format(type(obj).__name__, len(obj)).encode('utf-8'))
+        for item in obj:
+            _update_fingerprint(digest, item)
+    else:
+        digest.update(repr(obj).encode('utf-8'))
+
+
+def fingerprint(*objects):
+    """
+    Computes a short content hash of arrays and plain Python objects, to be used as cache key
+
+    :param objects: Objects to be hashed (arrays, lists, tuples, dictionaries or objects with a stable repr)
+    :type objects: object
+    :return: Hexadecimal digest of the objects
+    :rtype: basestring
+    """
+    digest = hashlib.sha1()
+    for obj in objects:
+        _update_fingerprint(digest, obj)
+    return digest.hexdigest()[:16]
+
+
 def log(message='', out='stdout'):
     if out == 'stderr':
         sys.stderr.write('{}\n'.format(message))
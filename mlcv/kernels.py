@@ -1,65 +1,741 @@
+from multiprocessing.pool import ThreadPool
+import os
+
 import numpy as np
+import scipy.sparse as sp
+
+import mlcv.input_output as io
+import mlcv.pyramid as pyramid
 import mlcv.settings as settings
 
-MAX_NUM_ELEMS = 1e8
+# Maximum number of bytes used by the temporary tiles of the kernel computations (shared by all the threads)
+MEMORY_BUDGET = 2 ** 26
+# Size in bytes of the temporary array of each tile, small enough to stay in the CPU cache
+TILE_BYTES = 2 ** 20
+# Maximum number of features processed at once by each tile
+MAX_TILE_FEATURES = 512
+
+# Number of rows of the tiles when the features are expanded tile by tile (compact pyramids)
+EXPANDED_TILE_ROWS = 64
+
+# Weight of each feature in the pyramid match kernel, for each pyramid layout
+_PYRAMID_WEIGHTS = {}
+
+
+def _value_range(X):
+    values = X.data if sp.issparse(X) else X
+    if values.size == 0:
+        return 0, 0
+    return values.min(), values.max()
+
+
+def _whole_numbers(X):
+    values = X.data if sp.issparse(X) else X
+    return X.dtype.kind in 'biu' or bool(np.all(values == np.round(values)))
+
 
+def _integer_features(X):
+    # Whole-number features (e.g. the float64 counts of bovw.visual_words) as integers, for the integer arithmetic
+    if X.dtype.kind in 'biu':
+        return X
+    return X.astype(np.int64)
 
-def intersection_kernel(X, Y):
+
+def kernel_dtype(X, Y=None, dtype=None):
+    """
+    Chooses the data types used by the kernel engine: the one of the element-wise arithmetic and the one of the
+    accumulation, which is also the data type of the returned Gram matrix.
+
+    - Floating point arithmetic accumulates in the same precision: float32 halves the memory traffic of float64.
+    - Integer arithmetic (raw count histograms) uses the narrowest type able to hold the values (uint16 for counts),
+      and accumulates in int32 when n_features * max_value cannot overflow it, or in int64 otherwise. It can be
+      requested for floating point features holding whole numbers, such as unnormalized visual words, which are cast.
+
+    :param X: X matrix with dimensions (n_samples_x, n_features)
+    :type X: numpy.ndarray, scipy.sparse.spmatrix
+    :param Y: Y matrix with dimensions (n_samples_y, n_features). If None, Y = X
+    :type Y: numpy.ndarray, scipy.sparse.spmatrix
+    :param dtype: Requested arithmetic data type. If None, float32 is used for float32 inputs, integer arithmetic for
+                  integer inputs and float64 otherwise
+    :type dtype: numpy.dtype
+
+    :return: A tuple with the arithmetic and the accumulation data types
+    :rtype: tuple
+    """
+    Y = X if Y is None else Y
+    if dtype is None:
+        if X.dtype.kind in 'biu' and Y.dtype.kind in 'biu':
+            dtype = np.int64
+        elif X.dtype == np.float32 and Y.dtype == np.float32:
+            dtype = np.float32
+        else:
+            dtype = np.float64
+        narrowest = True
+    else:
+        narrowest = False
+    dtype = np.dtype(dtype)
+
+    if dtype.kind not in 'biu':
+        return dtype, dtype
+
+    if not _whole_numbers(X) or not _whole_numbers(Y):
+        raise ValueError('Integer arithmetic requires integer features or whole numbers, got {} and {}'.format(
+            X.dtype, Y.dtype))
+    x_min, x_max = _value_range(X)
+    y_min, y_max = _value_range(Y)
+    min_value, max_value = min(x_min, y_min), max(x_max, y_max)
+
+    if narrowest:
+        for candidate in (np.uint16, np.int32, np.int64):
+            info = np.iinfo(candidate)
+            if info.min <= min_value and max_value <= info.max:
+                dtype = np.dtype(candidate)
+                break
+    elif not np.iinfo(dtype).min <= min_value or not max_value <= np.iinfo(dtype).max:
+        raise ValueError('Features in [{}, {}] overflow {}'.format(min_value, max_value, dtype))
+
+    # Bound of the absolute value of any entry of the Gram matrix
+    bound = int(X.shape[1]) * int(max(abs(int(min_value)), abs(int(max_value))))
+    accumulator = np.dtype(np.int32 if bound <= np.iinfo(np.int32).max else np.int64)
+    return dtype, accumulator
+
+
+def _gram_output(out, shape, dtype):
+    # Array where the Gram matrix is accumulated: a new one, the given one (e.g. a memmap) or a new .npy file
+    if out is None:
+        return np.zeros(shape, dtype=dtype)
+    if isinstance(out, np.ndarray):
+        if out.shape != shape:
+            raise ValueError('The output has shape {}, but the Gram matrix has shape {}'.format(out.shape, shape))
+        out[...] = 0
+        return out
+    return np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+
+
+def _gram_result(gram, out):
+    if isinstance(gram, np.memmap):
+        gram.flush()
+        if not isinstance(out, np.ndarray):
+            # Reopened read-only, so that worker processes open the same file instead of receiving copies
+            return np.load(out, mmap_mode='r')
+    return gram
+
+
+def _tile_shape(n_samples_x, n_samples_y, n_features, itemsize, memory_budget, n_threads):
+    # Each tile materializes a (tile_x, tile_y, tile_features) temporary array
+    tile_budget = max(min(TILE_BYTES, memory_budget // n_threads) // itemsize, 1)
+    tile_features = int(min(n_features, MAX_TILE_FEATURES, tile_budget))
+    tile_rows = max(int(np.sqrt(tile_budget // tile_features)), 1)
+    return min(tile_rows, n_samples_x), min(tile_rows, n_samples_y), tile_features
+
+
+def _float_dtype(X, Y, dtype):
+    # Kernels with divisions or square roots are computed in floating point, float32 only if requested or if both
+    # matrices are float32
+    if dtype is None:
+        return np.dtype(np.float32 if X.dtype == np.float32 and Y.dtype == np.float32 else np.float64)
+    dtype = np.dtype(dtype)
+    if dtype.kind != 'f':
+        raise ValueError('The kernel requires floating point arithmetic, got {}'.format(dtype))
+    return dtype
+
+
+def _intersection_tile(X, Y, out, tile_features):
+    for k in range(0, X.shape[1], tile_features):
+        minim = np.minimum(X[:, None, k:k + tile_features], Y[None, :, k:k + tile_features])
+        out += np.sum(minim, axis=2, dtype=out.dtype)
+
+
+def _chi2_pairs(x, y):
+    # 2xy / (x + y), where 0 / 0 is taken as 0
+    total = x + y
+    return 2 * x * y / np.where(total > 0, total, 1)
+
+
+def _chi2_tile(X, Y, out, tile_features):
+    for k in range(0, X.shape[1], tile_features):
+        out += np.sum(_chi2_pairs(X[:, None, k:k + tile_features], Y[None, :, k:k + tile_features]), axis=2)
+
+
+def _tiled_gram(X, Y, tile_function, symmetric, dtype, memory_budget, n_jobs, tile_shape=None, n_temporaries=1,
+                out=None):
+    n_samples_x, n_features = X.shape
+    n_samples_y, _ = Y.shape
+    memory_budget = MEMORY_BUDGET if memory_budget is None else memory_budget
+    n_jobs = settings.n_jobs if n_jobs is None else n_jobs
+
+    if tile_shape is None:
+        # Each tile function materializes n_temporaries arrays with the shape of a tile at the same time
+        itemsize = max(X.dtype.itemsize, Y.dtype.itemsize) * n_temporaries
+        tile_shape = _tile_shape(n_samples_x, n_samples_y, n_features, itemsize, memory_budget, max(n_jobs, 1))
+    tile_x, tile_y, tile_features = tile_shape
+    gram = _gram_output(out, (n_samples_x, n_samples_y), dtype)
+
+    if symmetric:
+        # Only the tiles of the upper triangle are computed, and mirrored to the lower one
+        tile_x = tile_y = min(tile_x, tile_y)
+        tiles = [(i, j) for i in range(0, n_samples_x, tile_x) for j in range(i, n_samples_y, tile_y)]
+    else:
+        tiles = [(i, j) for i in range(0, n_samples_x, tile_x) for j in range(0, n_samples_y, tile_y)]
+
+    def compute_tile(tile):
+        i, j = tile
+        tile_function(X[i:i + tile_x], Y[j:j + tile_y], gram[i:i + tile_x, j:j + tile_y], tile_features)
+        if symmetric and i != j:
+            gram[j:j + tile_y, i:i + tile_x] = gram[i:i + tile_x, j:j + tile_y].T
+
+    if n_jobs > 1 and len(tiles) > 1:
+        # NumPy releases the GIL on the element-wise operations, so the tiles are computed in parallel threads
+        pool = ThreadPool(min(n_jobs, len(tiles)))
+        try:
+            pool.map(compute_tile, tiles)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for tile in tiles:
+            compute_tile(tile)
+
+    return gram
+
+
+def _sparse_additive_gram(X, Y, pair_function, symmetric, dtype, memory_budget, out=None):
+    # Additive kernel sum_k f(x_k, y_k) between non-negative sparse matrices, for functions with f(x, 0) = 0 (e.g.
+    # the minimum or chi2). Y is indexed by columns, so that each non-zero of a row of X is only compared with the
+    # non-zeros of Y in the same column
+    X = sp.csr_matrix(X)
+    Y = sp.csc_matrix(Y)
+    if (X.nnz > 0 and X.data.min() < 0) or (Y.nnz > 0 and Y.data.min() < 0):
+        raise ValueError('Sparse additive kernels require non-negative features')
+
+    n_samples_x = X.shape[0]
+    n_samples_y = Y.shape[0]
+    memory_budget = MEMORY_BUDGET if memory_budget is None else memory_budget
+    gram = _gram_output(out, (n_samples_x, n_samples_y), dtype)
+
+    # Number of co-occurring non-zeros of each row of X, to group the rows in blocks that fit in the memory budget
+    y_column_nnz = np.diff(Y.indptr)
+    x_row_cost = np.add.reduceat(np.append(y_column_nnz[X.indices], 0), X.indptr[:-1]) * (np.diff(X.indptr) > 0)
+    max_block_cost = max(memory_budget // (4 * 8), 1)
+    if symmetric:
+        # With the rows of each column of Y sorted, the position of the first non-zero of a column at or after a
+        # given row is found with a binary search on (column, row)
+        Y.sort_indices()
+        y_keys = np.repeat(np.arange(Y.shape[1], dtype=np.int64), y_column_nnz) * n_samples_y + Y.indices
+
+    start = 0
+    while start < n_samples_x:
+        # When symmetric, each block of rows is only compared with the samples of Y from its first row onwards (the
+        # upper triangle), and mirrored to the lower one
+        first = start if symmetric else 0
+        width = n_samples_y - first
+        end = start + 1
+        block_cost = x_row_cost[start]
+        while end < n_samples_x and block_cost + x_row_cost[end] <= max_block_cost and \
+                (end - start + 1) * width <= max_block_cost:
+            block_cost += x_row_cost[end]
+            end += 1
+
+        nz_start, nz_end = X.indptr[start], X.indptr[end]
+        x_rows = np.repeat(np.arange(end - start), np.diff(X.indptr[start:end + 1]))
+        x_columns = X.indices[nz_start:nz_end]
+        x_values = X.data[nz_start:nz_end]
+
+        # Position in Y of every non-zero sharing a column with each non-zero of the block
+        if symmetric:
+            y_starts = np.searchsorted(y_keys, x_columns.astype(np.int64) * n_samples_y + first)
+        else:
+            y_starts = Y.indptr[x_columns]
+        lengths = Y.indptr[x_columns + 1] - y_starts
+        total = lengths.sum()
+        offsets = np.repeat(y_starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+        values = pair_function(np.repeat(x_values, lengths), Y.data[offsets])
+        cells = np.repeat(x_rows, lengths) * width + Y.indices[offsets] - first
+        block = np.bincount(cells, weights=values, minlength=(end - start) * width).reshape(end - start, width)
+        gram[start:end, first:] = block
+        if symmetric:
+            gram[end:, start:end] = block[:, end - start:].T
+        start = end
+
+    return gram
+
+
+def _compact_pyramid_gram(X, Y, symmetric, level_weights, dtype, memory_budget, n_jobs, out=None):
+    # The full pyramid representations are expanded from the compact ones tile by tile, so they are never stored
+    layout = pyramid.pyramid_layout()
+    parents = pyramid.cell_parents(layout)
+    n_expanded = sum(cells_i * cells_j for _, _, cells_i, cells_j in layout) * X.shape[1] // parents[0].shape[0]
+    dtype = np.dtype(np.float32 if dtype == np.float32 else np.float64)
+
+    def expand(block):
+        return pyramid.expand_pyramid(block, level_weights=level_weights, dtype=dtype, layout=layout, parents=parents)
+
+    def tile_function(X_block, Y_block, out, tile_features):
+        _intersection_tile(expand(X_block), expand(Y_block), out, tile_features)
+
+    memory_budget = MEMORY_BUDGET if memory_budget is None else memory_budget
+    n_jobs = settings.n_jobs if n_jobs is None else n_jobs
+    itemsize = dtype.itemsize
+    tile_rows = min(EXPANDED_TILE_ROWS, max(X.shape[0], Y.shape[0]))
+    tile_budget = max(min(TILE_BYTES, memory_budget // max(n_jobs, 1)) // itemsize, 1)
+    tile_features = int(min(n_expanded, MAX_TILE_FEATURES, max(tile_budget // (tile_rows * tile_rows), 1)))
+
+    return _tiled_gram(X, Y, tile_function, symmetric, dtype, memory_budget, n_jobs,
+                       tile_shape=(tile_rows, tile_rows, tile_features), out=out)
+
+
+def _check_pair(X, Y, symmetric):
+    if Y is None:
+        Y = X
+    if symmetric is None:
+        symmetric = Y is X
+    if sp.issparse(X) or sp.issparse(Y):
+        return X, Y, symmetric
+    return np.asarray(X), np.asarray(Y), symmetric
+
+
+def intersection_kernel(X, Y=None, symmetric=None, compact=False, dtype=None, memory_budget=None, n_jobs=None,
+                        out=None):
     """
     Computes the Gram matrix between matrix X and Y using the intersection kernel.
     K(x_i, x_j) = sum_{k=0}^{n_features} min(x_ik, x_jk)
 
+    The computation is split in tiles over the rows of X, the rows of Y and the features, so that the temporary
+    arrays never exceed the memory budget, and the tiles are computed in a pool of threads. When the Gram matrix is
+    symmetric (Y is X) only the upper triangular tiles are computed.
+
+    Sparse matrices of non-negative features (e.g. BoVW histograms) are supported: only the non-zeros that share a
+    column are compared, so the cost scales with the number of non-zeros instead of the number of features.
+
+    :param X: X matrix with dimensions (n_samples_x, n_features)
+    :type X: numpy.ndarray, scipy.sparse.spmatrix
+    :param Y: Y matrix with dimensions (n_samples_y, n_features). If None, Y = X
+    :type Y: numpy.ndarray, scipy.sparse.spmatrix
+    :param symmetric: Whether X and Y are the same matrix. If None, it is detected with `Y is X`
+    :type symmetric: bool
+    :param compact: X and Y are compact pyramid representations (see bovw.build_pyramid), which are expanded to the
+                    full representations tile by tile
+    :type compact: bool
+    :param dtype: Data type of the arithmetic (see kernel_dtype), e.g. numpy.float32 for single precision or
+                  numpy.uint16 for raw count histograms. If None, it is chosen from the data type of the features
+    :type dtype: numpy.dtype
+    :param memory_budget: Maximum number of bytes used by the temporary tiles (MEMORY_BUDGET by default)
+    :type memory_budget: int
+    :param n_jobs: Number of threads (settings.n_jobs by default)
+    :type n_jobs: int
+    :param out: Where the Gram matrix is written: an array (e.g. a numpy.memmap) with its shape, or the filename of a
+                new .npy file, which is returned memory-mapped read-only. If None, it is allocated in memory
+    :type out: numpy.ndarray, basestring
+
+    :return: Gram matrix with dimensions (n_samples_x, n_samples_y), with the accumulation data type of kernel_dtype
+    :rtype: numpy.ndarray
+    """
+    X, Y, symmetric = _check_pair(X, Y, symmetric)
+    if compact:
+        gram = _compact_pyramid_gram(X, Y, symmetric, None, dtype, memory_budget, n_jobs, out=out)
+        return _gram_result(gram, out)
+
+    dtype, accumulator = kernel_dtype(X, Y, dtype)
+    if sp.issparse(X) or sp.issparse(Y):
+        gram = _sparse_additive_gram(X, Y, np.minimum, symmetric, accumulator, memory_budget, out=out)
+        return _gram_result(gram, out)
+
+    X = X.astype(dtype, copy=False)
+    Y = X if symmetric else Y.astype(dtype, copy=False)
+    gram = _tiled_gram(X, Y, _intersection_tile, symmetric, accumulator, memory_budget, n_jobs, out=out)
+    return _gram_result(gram, out)
+
+
+def _level_weights(num_levels):
+    # The pyramid match kernel is I_0 + sum_{i>0} 2^-i (I_i - I_{i-1}), where level 0 is the finest one, which is a
+    # linear combination of the intersections of each level with non-negative weights. Levels are ordered as in
+    # settings.pyramid_levels, from the coarsest to the finest one
+    level_weights = []
+    for level in range(num_levels):
+        i = num_levels - 1 - level
+        level_weights.append(2.0 ** -i - (2.0 ** -(i + 1) if i < num_levels - 1 else 0))
+    return level_weights
+
+
+def _pyramid_weights(n_features):
+    levels = tuple(tuple(level) for level in settings.pyramid_levels)
+    key = (levels, n_features)
+    weights = _PYRAMID_WEIGHTS.get(key)
+    if weights is not None:
+        return weights
+
+    num_cells = [num_rows * num_cols for num_rows, num_cols in levels]
+    if n_features % sum(num_cells) != 0:
+        raise ValueError('{} features do not match a pyramid with levels {}'.format(n_features, list(levels)))
+    k = n_features // sum(num_cells)
+
+    weights = np.repeat(_level_weights(len(levels)), [cells * k for cells in num_cells])
+    _PYRAMID_WEIGHTS[key] = weights
+    return weights
+
+
+def pyramid_kernel(X, Y=None, symmetric=None, compact=False, dtype=None, memory_budget=None, n_jobs=None, out=None):
+    """
+    Computes the Gram matrix between matrix X and Y using the pyramid match kernel, given the spatial pyramid
+    representations built by bovw.build_pyramid with the levels in settings.pyramid_levels.
+
+    Since min(w * a, w * b) = w * min(a, b) for w >= 0, the kernel is computed as a single intersection kernel over
+    the features weighted by the weight of their level. It does not modify any global state, so it can be called
+    concurrently.
+
     :param X: X matrix with dimensions (n_samples_x, n_features)
+    :type X: numpy.ndarray, scipy.sparse.spmatrix
+    :param Y: Y matrix with dimensions (n_samples_y, n_features). If None, Y = X
+    :type Y: numpy.ndarray, scipy.sparse.spmatrix
+    :param symmetric: Whether X and Y are the same matrix. If None, it is detected with `Y is X`
+    :type symmetric: bool
+    :param compact: X and Y are compact pyramid representations (see bovw.build_pyramid), whose coarser levels are
+                    derived tile by tile during the kernel evaluation
+    :type compact: bool
+    :param dtype: Data type of the arithmetic (see kernel_dtype), e.g. numpy.float32 for single precision or
+                  numpy.uint16 for raw count histograms. If None, it is chosen from the data type of the features
+    :type dtype: numpy.dtype
+    :param memory_budget: Maximum number of bytes used by the temporary tiles (MEMORY_BUDGET by default)
+    :type memory_budget: int
+    :param n_jobs: Number of threads (settings.n_jobs by default)
+    :type n_jobs: int
+    :param out: Where the Gram matrix is written: an array (e.g. a numpy.memmap) with its shape, or the filename of a
+                new .npy file, which is returned memory-mapped read-only. If None, it is allocated in memory
+    :type out: numpy.ndarray, basestring
+
+    :return: Gram matrix with dimensions (n_samples_x, n_samples_y)
+    :rtype: numpy.ndarray
+    """
+    X, Y, symmetric = _check_pair(X, Y, symmetric)
+    if compact:
+        level_weights = _level_weights(len(settings.pyramid_levels))
+        gram = _compact_pyramid_gram(X, Y, symmetric, level_weights, dtype, memory_budget, n_jobs, out=out)
+        return _gram_result(gram, out)
+
+    dtype, _ = kernel_dtype(X, Y, dtype)
+    if dtype.kind in 'biu' and out is not None:
+        # The integer Gram matrix would have to be rescaled, so the output is computed in floating point directly
+        dtype = np.dtype(np.float64)
+    weights = _pyramid_weights(X.shape[1])
+    scale = 1
+    if dtype.kind in 'biu':
+        # The weights are powers of 2, so integer counts are scaled by the inverse of the smallest one
+        scale = 1.0 / weights.min()
+        weights = np.asarray(np.round(weights * scale), dtype=np.int64)
+        X = _integer_features(X)
+        Y = X if symmetric else _integer_features(Y)
+    else:
+        weights = weights.astype(dtype)
+
+    def weigh(features):
+        if sp.issparse(features):
+            return sp.csr_matrix(features.multiply(weights))
+        return features * weights
+
+    X_weighted = weigh(X)
+    Y_weighted = X_weighted if symmetric else weigh(Y)
+
+    gram = intersection_kernel(X_weighted, Y_weighted, symmetric=symmetric, memory_budget=memory_budget,
+                               n_jobs=n_jobs, dtype=None if dtype.kind in 'biu' else dtype, out=out)
+    return gram / scale if scale != 1 else gram
+
+
+def compact_pyramid_kernel(X, Y=None, symmetric=None, dtype=None, memory_budget=None, n_jobs=None, out=None):
+    """
+    Computes the Gram matrix between matrix X and Y using the pyramid match kernel, given the compact pyramid
+    representations built by bovw.build_pyramid with compact=True. It is pyramid_kernel with compact=True, as a
+    function of its own so that it can be used as the kernel of an SVM (see classification.KERNELS).
+
+    :param X: X matrix with dimensions (n_samples_x, n_finest_cells * codebook_size)
     :type X: numpy.ndarray
-    :param Y: Y matrix with dimensions (n_samples_y, n_features)
+    :param Y: Y matrix with dimensions (n_samples_y, n_finest_cells * codebook_size). If None, Y = X
     :type Y: numpy.ndarray
+    :param symmetric: Whether X and Y are the same matrix. If None, it is detected with `Y is X`
+    :type symmetric: bool
+    :param dtype: Floating point data type of the arithmetic: numpy.float32, or numpy.float64 otherwise
+    :type dtype: numpy.dtype
+    :param memory_budget: Maximum number of bytes used by the temporary tiles (MEMORY_BUDGET by default)
+    :type memory_budget: int
+    :param n_jobs: Number of threads (settings.n_jobs by default)
+    :type n_jobs: int
+    :param out: Where the Gram matrix is written: an array (e.g. a numpy.memmap) with its shape, or the filename of a
+                new .npy file, which is returned memory-mapped read-only. If None, it is allocated in memory
+    :type out: numpy.ndarray, basestring
 
     :return: Gram matrix with dimensions (n_samples_x, n_samples_y)
     :rtype: numpy.ndarray
     """
-    n_samples_x, n_features = X.shape
-    n_samples_y, _ = Y.shape
+    return pyramid_kernel(X, Y, symmetric=symmetric, compact=True, dtype=dtype, memory_budget=memory_budget,
+                          n_jobs=n_jobs, out=out)
 
-    if n_samples_x * n_samples_y * n_features < MAX_NUM_ELEMS:
-        # Computationally efficient version (requires more memory)
-        minim = np.minimum(X[:, :, None], Y[:, :, None].T)
-        intersection = np.sum(minim, axis=1)
-    else:
-        # Memory efficient version (requires more computation time)
-        x_slicing = int(np.floor(MAX_NUM_ELEMS / (n_samples_y * n_features)))
-        intersection = np.zeros((n_samples_x, n_samples_y))
 
-        for i in range(0, n_samples_x, x_slicing):
-            minim = np.minimum(X[i:i + x_slicing, :, None], Y[:, :, None].T)
-            intersection[i:i + x_slicing, :] = np.sum(minim, axis=1)
+def chi2_kernel(X, Y=None, symmetric=None, dtype=None, memory_budget=None, n_jobs=None, out=None):
+    """
+    Computes the Gram matrix between matrix X and Y using the additive chi2 kernel, for non-negative features (e.g.
+    histograms). Terms where both features are 0 are taken as 0.
+    K(x_i, x_j) = sum_{k=0}^{n_features} 2 * x_ik * x_jk / (x_ik + x_jk)
 
-    return intersection
+    It is computed with the same tiled engine as intersection_kernel, including the symmetric and sparse paths.
 
+    :param X: X matrix with dimensions (n_samples_x, n_features)
+    :type X: numpy.ndarray, scipy.sparse.spmatrix
+    :param Y: Y matrix with dimensions (n_samples_y, n_features). If None, Y = X
+    :type Y: numpy.ndarray, scipy.sparse.spmatrix
+    :param symmetric: Whether X and Y are the same matrix. If None, it is detected with `Y is X`
+    :type symmetric: bool
+    :param dtype: Floating point data type of the arithmetic and the Gram matrix. If None, float32 is used if both
+                  matrices are float32 and float64 otherwise
+    :type dtype: numpy.dtype
+    :param memory_budget: Maximum number of bytes used by the temporary tiles (MEMORY_BUDGET by default)
+    :type memory_budget: int
+    :param n_jobs: Number of threads (settings.n_jobs by default)
+    :type n_jobs: int
+    :param out: Where the Gram matrix is written: an array (e.g. a numpy.memmap) with its shape, or the filename of a
+                new .npy file, which is returned memory-mapped read-only. If None, it is allocated in memory
+    :type out: numpy.ndarray, basestring
 
-def pyramid_kernel(X, Y):
+    :return: Gram matrix with dimensions (n_samples_x, n_samples_y)
+    :rtype: numpy.ndarray
+    """
+    X, Y, symmetric = _check_pair(X, Y, symmetric)
+    dtype = _float_dtype(X, Y, dtype)
+    if sp.issparse(X) or sp.issparse(Y):
+        gram = _sparse_additive_gram(X, Y, _chi2_pairs, symmetric, dtype, memory_budget, out=out)
+        return _gram_result(gram, out)
 
-    # Reverse vectors to start with level 0 (the one with finer grid)
-    settings.pyramid_levels.reverse()
-    X = np.fliplr(X)
-    Y = np.fliplr(Y)
+    X = X.astype(dtype, copy=False)
+    Y = X if symmetric else Y.astype(dtype, copy=False)
+    gram = _tiled_gram(X, Y, _chi2_tile, symmetric, dtype, memory_budget, n_jobs, n_temporaries=3, out=out)
+    return _gram_result(gram, out)
 
-    last_index = 0
 
-    for i in range(0,len(settings.pyramid_levels)):
+def _signed_sqrt(X, dtype):
+    if sp.issparse(X):
+        X = sp.csr_matrix(X, dtype=dtype, copy=True)
+        X.data = np.sign(X.data) * np.sqrt(np.abs(X.data))
+        return X
+    X = X.astype(dtype, copy=False)
+    return np.sign(X) * np.sqrt(np.abs(X))
 
-        num_partitions = settings.pyramid_levels[i][0] * \
-                         settings.pyramid_levels[i][1]
 
-        this_level_intersection = intersection_kernel(
-                            X[:,last_index:last_index+settings.codebook_size*num_partitions],
-                            Y[:,last_index:last_index+settings.codebook_size*num_partitions])
+def hellinger_kernel(X, Y=None, symmetric=None, dtype=None, memory_budget=None, out=None):
+    """
+    Computes the Gram matrix between matrix X and Y using the Hellinger (Bhattacharyya) kernel. Features are mapped
+    to their signed square root, so that the kernel is a single matrix product, computed by BLAS.
+    K(x_i, x_j) = sum_{k=0}^{n_features} sqrt(x_ik * x_jk)
 
-        if i == 0:
-            intersection = this_level_intersection
-        else:
-            intersection += 2**-i * (this_level_intersection - previous_level_intersection)
+    :param X: X matrix with dimensions (n_samples_x, n_features)
+    :type X: numpy.ndarray, scipy.sparse.spmatrix
+    :param Y: Y matrix with dimensions (n_samples_y, n_features). If None, Y = X
+    :type Y: numpy.ndarray, scipy.sparse.spmatrix
+    :param symmetric: Whether X and Y are the same matrix. If None, it is detected with `Y is X`
+    :type symmetric: bool
+    :param dtype: Floating point data type of the arithmetic and the Gram matrix. If None, float32 is used if both
+                  matrices are float32 and float64 otherwise
+    :type dtype: numpy.dtype
+    :param memory_budget: Maximum number of bytes of the blocks of rows written to out (MEMORY_BUDGET by default)
+    :type memory_budget: int
+    :param out: Where the Gram matrix is written: an array (e.g. a numpy.memmap) with its shape, or the filename of a
+                new .npy file, which is returned memory-mapped read-only. If None, it is allocated in memory
+    :type out: numpy.ndarray, basestring
+
+    :return: Gram matrix with dimensions (n_samples_x, n_samples_y)
+    :rtype: numpy.ndarray
+    """
+    X, Y, symmetric = _check_pair(X, Y, symmetric)
+    dtype = _float_dtype(X, Y, dtype)
+    X_sqrt = _signed_sqrt(X, dtype)
+    Y_sqrt = X_sqrt if symmetric else _signed_sqrt(Y, dtype)
+
+    def product(rows):
+        block = rows.dot(Y_sqrt.T)
+        return block.toarray() if sp.issparse(block) else block
+
+    if out is None:
+        return np.asarray(product(X_sqrt), dtype=dtype)
+
+    # The products are computed by blocks of rows, so that only the output is stored in full
+    memory_budget = MEMORY_BUDGET if memory_budget is None else memory_budget
+    gram = _gram_output(out, (X.shape[0], Y.shape[0]), dtype)
+    block_rows = max(memory_budget // (max(Y.shape[0], 1) * dtype.itemsize), 1)
+    for i in range(0, X.shape[0], block_rows):
+        gram[i:i + block_rows] = product(X_sqrt[i:i + block_rows])
+    return _gram_result(gram, out)
+
+
+def generalized_intersection_kernel(X, Y=None, beta=0.5, symmetric=None, dtype=None, memory_budget=None,
+                                    n_jobs=None, out=None):
+    """
+    Computes the Gram matrix between matrix X and Y using the generalized histogram intersection kernel (Boughorbel
+    et al.), which is positive definite for any beta > 0 and does not require non-negative features.
+    K(x_i, x_j) = sum_{k=0}^{n_features} min(|x_ik|^beta, |x_jk|^beta)
+
+    :param X: X matrix with dimensions (n_samples_x, n_features)
+    :type X: numpy.ndarray, scipy.sparse.spmatrix
+    :param Y: Y matrix with dimensions (n_samples_y, n_features). If None, Y = X
+    :type Y: numpy.ndarray, scipy.sparse.spmatrix
+    :param beta: Exponent applied to the absolute value of the features
+    :type beta: float
+    :param symmetric: Whether X and Y are the same matrix. If None, it is detected with `Y is X`
+    :type symmetric: bool
+    :param dtype: Floating point data type of the arithmetic and the Gram matrix. If None, float32 is used if both
+                  matrices are float32 and float64 otherwise
+    :type dtype: numpy.dtype
+    :param memory_budget: Maximum number of bytes used by the temporary tiles (MEMORY_BUDGET by default)
+    :type memory_budget: int
+    :param n_jobs: Number of threads (settings.n_jobs by default)
+    :type n_jobs: int
+    :param out: Where the Gram matrix is written: an array (e.g. a numpy.memmap) with its shape, or the filename of a
+                new .npy file, which is returned memory-mapped read-only. If None, it is allocated in memory
+    :type out: numpy.ndarray, basestring
+
+    :return: Gram matrix with dimensions (n_samples_x, n_samples_y)
+    :rtype: numpy.ndarray
+    """
+    X, Y, symmetric = _check_pair(X, Y, symmetric)
+    dtype = _float_dtype(X, Y, dtype)
+
+    def power(features):
+        if sp.issparse(features):
+            features = sp.csr_matrix(features, dtype=dtype, copy=True)
+            features.data = np.abs(features.data) ** beta
+            return features
+        return np.abs(features.astype(dtype, copy=False)) ** beta
+
+    X_power = power(X)
+    Y_power = X_power if symmetric else power(Y)
+    return intersection_kernel(X_power, Y_power, symmetric=symmetric, dtype=dtype, memory_budget=memory_budget,
+                               n_jobs=n_jobs, out=out)
+
+
+class IncrementalGram(object):
+    """
+    Gram matrix of a training set that grows as new samples are appended: only the kernel between the new samples
+    and the stored ones, K(new, old), and between the new samples, K(new, new), is computed, so appending n_new
+    samples to n samples costs O(n * n_new) kernel evaluations instead of recomputing the O(n^2) matrix.
+
+    The matrix is stored in a buffer whose capacity is doubled when it is full, either in memory or in a
+    memory-mapped .npy file (whose array has the shape of the buffer, of which only the first n_samples rows and
+    columns are valid). The kernel must be symmetric, K(old, new) is the transpose of K(new, old).
+
+    It can be passed instead of the training matrix to classification.gram_matrix, train_kernel_svm and
+    cross_validate_precomputed_svm, which then use its Gram matrix instead of recomputing it. gram_matrix also stores
+    it in its memory cache under its fingerprint, where later calls with the features alone find it.
+    """
+
+    def __init__(self, X=None, kernel=intersection_kernel, dtype=np.float64, filename=None, capacity=0):
+        """
+        :param X: Initial features with dimensions (n_samples, n_features)
+        :type X: numpy.ndarray
+        :param kernel: Symmetric kernel function, called as kernel(X, Y)
+        :type kernel: function
+        :param dtype: Data type of the stored matrix
+        :type dtype: numpy.dtype
+        :param filename: Filename of the .npy file where the matrix is stored memory-mapped. If None, it is stored in
+                         memory
+        :type filename: basestring
+        :param capacity: Initial number of samples of the buffer
+        :type capacity: int
+        """
+        self.kernel = kernel
+        self.dtype = np.dtype(dtype)
+        self.filename = filename
+        self._fingerprint = None
+        self.n_samples = 0
+        self._features = None
+        self._gram = self._allocate(capacity)
+        if X is not None:
+            self.append(X)
+
+    @property
+    def gram(self):
+        """
+        :return: Gram matrix of the stored features, with dimensions (n_samples, n_samples)
+        :rtype: numpy.ndarray
+        """
+        return self._gram[:self.n_samples, :self.n_samples]
+
+    @property
+    def fingerprint(self):
+        """
+        :return: Fingerprint of the stored features (and of settings.pyramid_levels for the pyramid kernels), the
+                 one of the key of classification.gram_matrix, which does not depend on how the samples were split in
+                 appended batches
+        :rtype: basestring
+        """
+        levels = settings.pyramid_levels if self.kernel in (pyramid_kernel, compact_pyramid_kernel) else None
+        if self._fingerprint is None or self._fingerprint[0] != levels:
+            self._fingerprint = (levels, io.fingerprint(self.features if self.n_samples else None, levels))
+        return self._fingerprint[1]
+
+    @property
+    def features(self):
+        """
+        :return: Stored features with dimensions (n_samples, n_features)
+        :rtype: numpy.ndarray
+        """
+        return self._features[:self.n_samples]
+
+    def _allocate(self, capacity):
+        if self.filename is None:
+            return np.zeros((capacity, capacity), dtype=self.dtype)
+        return np.lib.format.open_memmap(self.filename, mode='w+', dtype=self.dtype, shape=(capacity, capacity))
+
+    def _reserve(self, n_samples, X_new):
+        capacity = self._gram.shape[0]
+        if n_samples > capacity:
+            capacity = max(2 * capacity, n_samples)
+            n = self.n_samples
+            if self.filename is None:
+                gram = self._allocate(capacity)
+                gram[:n, :n] = self._gram[:n, :n]
+            else:
+                # The buffer is copied into a new file, which replaces the old one once complete
+                filename = self.filename
+                self.filename = filename + '.partial'
+                gram = self._allocate(capacity)
+                gram[:n, :n] = self._gram[:n, :n]
+                gram.flush()
+                self._gram = None
+                os.rename(self.filename, filename)
+                self.filename = filename
+                gram = np.load(filename, mmap_mode='r+')
+            self._gram = gram
+
+        if self._features is None or n_samples > self._features.shape[0]:
+            dtype = X_new.dtype if self._features is None else self._features.dtype
+            features = np.empty((self._gram.shape[0], X_new.shape[1]), dtype=dtype)
+            if self._features is not None:
+                features[:self.n_samples] = self._features[:self.n_samples]
+            self._features = features
+
+    def append(self, X_new):
+        """
+        Appends new samples, computing only the kernel between them and the stored samples, and between them
+
+        :param X_new: New features with dimensions (n_new_samples, n_features)
+        :type X_new: numpy.ndarray
+        :return: The object itself
+        :rtype: IncrementalGram
+        """
+        X_new = np.asarray(X_new)
+        n, n_new = self.n_samples, X_new.shape[0]
+        if self._features is not None and X_new.shape[1] != self._features.shape[1]:
+            raise ValueError('{} features do not match the {} stored ones'.format(X_new.shape[1],
+                                                                                 self._features.shape[1]))
+        if n_new == 0:
+            return self
 
-        previous_level_intersection = this_level_intersection
-        last_index += settings.codebook_size * num_partitions
+        self._reserve(n + n_new, X_new)
+        if n > 0:
+            cross = self.kernel(X_new, self.features)
+            self._gram[n:n + n_new, :n] = cross
+            self._gram[:n, n:n + n_new] = cross.T
+        self._gram[n:n + n_new, n:n + n_new] = self.kernel(X_new, X_new)
+        self._features[n:n + n_new] = X_new
 
-    return intersection
+        self.n_samples = n + n_new
+        self._fingerprint = None
+        if isinstance(self._gram, np.memmap):
+            self._gram.flush()
+        return self
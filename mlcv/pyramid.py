@@ -0,0 +1,152 @@
+"""
+Layout of the spatial pyramid representations built by bovw.build_pyramid, for the grid of dense keypoints and the
+levels defined in the settings
+"""
+import math
+
+import numpy as np
+
+import mlcv.settings as settings
+
+
+def pyramid_layout():
+    """
+    Computes the grid of cells of each level of the pyramid, in the order of settings.pyramid_levels
+
+    :return: A list with a tuple (step_i, step_j, cells_i, cells_j) for each level, where the steps are the size of the
+             cells in keypoints and cells_i, cells_j the number of cells in each direction
+    :rtype: list
+    """
+    kp_i, kp_j = [int(v) for v in settings.get_keypoints_shape()]
+    layout = []
+    for num_rows, num_cols in settings.pyramid_levels:
+        step_i = int(math.ceil(float(kp_i) / float(num_rows)))
+        step_j = int(math.ceil(float(kp_j) / float(num_cols)))
+        cells_i = int(math.ceil(float(kp_i) / float(step_i)))
+        cells_j = int(math.ceil(float(kp_j) / float(step_j)))
+        layout.append((step_i, step_j, cells_i, cells_j))
+    return layout
+
+
+def finest_level(layout):
+    """
+    :return: Index of the level with the most cells
+    :rtype: int
+    """
+    return int(np.argmax([cells_i * cells_j for _, _, cells_i, cells_j in layout]))
+
+
+def _parent_cells(fine_step, fine_cells, coarse_step, n_keypoints):
+    # Coarse cell containing each fine cell along one direction
+    starts = np.arange(fine_cells) * fine_step
+    ends = np.minimum(starts + fine_step, n_keypoints) - 1
+    if np.any(starts // coarse_step != ends // coarse_step):
+        raise ValueError('The pyramid levels are not nested, coarse cells are not unions of finest cells')
+    return starts // coarse_step
+
+
+def cell_parents(layout):
+    """
+    Computes, for each level, the cell that contains each cell of the finest level
+
+    :return: A list with an array of length n_finest_cells for each level
+    :rtype: list
+    """
+    kp_i, kp_j = [int(v) for v in settings.get_keypoints_shape()]
+    fine_step_i, fine_step_j, fine_cells_i, fine_cells_j = layout[finest_level(layout)]
+
+    parents = []
+    for step_i, step_j, cells_i, cells_j in layout:
+        parent_i = _parent_cells(fine_step_i, fine_cells_i, step_i, kp_i)
+        parent_j = _parent_cells(fine_step_j, fine_cells_j, step_j, kp_j)
+        parents.append((parent_i[:, None] * cells_j + parent_j[None, :]).ravel())
+    return parents
+
+
+def expand_pyramid(compact, level_weights=None, dtype=np.float64, layout=None, parents=None):
+    """
+    Builds the full spatial pyramid representation (the one returned by bovw.build_pyramid) from the compact one,
+    which only stores the histograms of the finest level: every coarser cell is the sum of its finest cells.
+
+    :param compact: Compact representations with dimensions (n_images, n_finest_cells * codebook_size)
+    :type compact: numpy.ndarray
+    :param level_weights: Weight applied to the histograms of each level
+    :type level_weights: list
+    :param dtype: Data type of the full representation
+    :type dtype: numpy.dtype
+    :param layout: Precomputed pyramid_layout(), to avoid recomputing it on repeated calls
+    :type layout: list
+    :param parents: Precomputed cell_parents(layout), to avoid recomputing them on repeated calls
+    :type parents: list
+
+    :return: Full representations with dimensions (n_images, n_cells * codebook_size)
+    :rtype: numpy.ndarray
+    """
+    if layout is None:
+        layout = pyramid_layout()
+    if parents is None:
+        parents = cell_parents(layout)
+    n_fine_cells = parents[0].shape[0]
+    n_images = compact.shape[0]
+    if compact.shape[1] % n_fine_cells != 0:
+        raise ValueError('{} features do not match a compact pyramid with {} cells'.format(compact.shape[1],
+                                                                                        n_fine_cells))
+    k = compact.shape[1] // n_fine_cells
+    fine = compact.reshape(n_images, n_fine_cells, k)
+
+    levels = []
+    for level, (_, _, cells_i, cells_j) in enumerate(layout):
+        histograms = np.zeros((n_images, cells_i * cells_j, k), dtype=dtype)
+        for cell, parent in enumerate(parents[level]):
+            histograms[:, parent, :] += fine[:, cell, :]
+        if level_weights is not None:
+            histograms *= level_weights[level]
+        levels.append(histograms.reshape(n_images, -1))
+
+    return np.hstack(levels)
+
+
+def _position_in_image(descriptors_indices):
+    # Order of each descriptor among the descriptors of its image
+    order = np.argsort(descriptors_indices, kind='mergesort')
+    sorted_indices = descriptors_indices[order]
+    position = np.empty(descriptors_indices.shape[0], dtype=np.int64)
+    position[order] = np.arange(descriptors_indices.shape[0]) - np.searchsorted(sorted_indices, sorted_indices)
+    return position
+
+
+def pyramid_columns(prediction, descriptors_indices, layout, codebook_size):
+    """
+    Computes the column of each dense descriptor in the pyramid representation, for each level
+
+    :param prediction: Visual word of each descriptor
+    :type prediction: numpy.ndarray
+    :param descriptors_indices: Image index of each descriptor. The descriptors of each image are in the order of the
+                                dense keypoints (row by row)
+    :type descriptors_indices: numpy.ndarray
+    :param layout: Levels of the pyramid (see pyramid_layout)
+    :type layout: list
+    :param codebook_size: Number of visual words
+    :type codebook_size: int
+
+    :return: A list with the columns of the descriptors for each level, and the number of columns of the pyramid
+    :rtype: tuple
+    """
+    kp_i, kp_j = [int(v) for v in settings.get_keypoints_shape()]
+
+    descriptors_per_image = np.bincount(descriptors_indices)
+    if np.any(descriptors_per_image != kp_i * kp_j):
+        raise ValueError('Every image must have {} x {} dense descriptors to build the pyramid'.format(kp_i, kp_j))
+
+    position = _position_in_image(descriptors_indices)
+    row = position // kp_j
+    col = position % kp_j
+
+    columns = []
+    offset = 0
+    for step_i, step_j, cells_i, cells_j in layout:
+        cell = (row // step_i) * cells_j + col // step_j
+        columns.append(offset + cell * codebook_size + prediction)
+        offset += cells_i * cells_j * codebook_size
+
+    return columns, offset
@@ -0,0 +1,44 @@
+"""
+Decision rules of libsvm's multiclass SVMs, shared by the classifiers of mlcv.classification and by the exported
+predictors of mlcv.export, which must not import sklearn
+"""
+import numpy as np
+
+# Kernels evaluated by libsvm itself
+LIBSVM_KERNELS = ('linear', 'poly', 'rbf', 'sigmoid')
+
+
+def ovo_votes(decisions, n_classes):
+    """
+    Counts the votes of the one-vs-one problems. As in libsvm, class i only wins the vote of the pair (i, j) with a
+    strictly positive decision value, and ties between classes are resolved by argmax in favour of the lowest index.
+
+    :param decisions: Decision values of the pairs of classes (i, j) in libsvm's order (i < j, by i then j), positive
+                      for i, with dimensions (n_samples, n_pairs)
+    :type decisions: numpy.ndarray
+    :param n_classes: Number of classes
+    :type n_classes: int
+    :return: The votes and the summed decision values of each class, with dimensions (n_samples, n_classes)
+    :rtype: tuple
+    """
+    votes = np.zeros((decisions.shape[0], n_classes))
+    confidences = np.zeros((decisions.shape[0], n_classes))
+    pair = 0
+    for i in range(n_classes):
+        for j in range(i + 1, n_classes):
+            first = decisions[:, pair] > 0
+            votes[first, i] += 1
+            votes[~first, j] += 1
+            confidences[:, i] += decisions[:, pair]
+            confidences[:, j] -= decisions[:, pair]
+            pair += 1
+    return votes, confidences
+
+
+def ovo_scores(votes, confidences):
+    """
+    :return: Class scores of SVC with decision_function_shape='ovr': the votes plus the summed decision values scaled
+             to (-1/3, 1/3)
+    :rtype: numpy.ndarray
+    """
+    return votes + confidences / (3 * (np.abs(confidences) + 1))
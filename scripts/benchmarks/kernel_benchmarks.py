@@ -0,0 +1,326 @@
+"""
+Micro-benchmarks of the kernels and the encodings over synthetic data of several shapes, data types and sparsity
+levels. Each case reports its best time, its throughput, its peak memory (traced by tracemalloc) and whether its
+output equals the one of the reference (previous, loop-based) implementation.
+
+Results are written as JSON, and can be compared with a baseline to flag regressions:
+
+    $ python scripts/benchmarks/kernel_benchmarks.py --output ignore/benchmarks.json
+    $ python scripts/benchmarks/kernel_benchmarks.py --baseline ignore/benchmarks.json --tolerance 0.2
+"""
+from __future__ import print_function, division
+
+import argparse
+import json
+import math
+import platform
+import sys
+import time
+
+import numpy as np
+import scipy.sparse as sp
+import sklearn.cluster as cluster
+
+import mlcv.bovw as bovw
+import mlcv.input_output as io
+import mlcv.kernels as kernels
+import mlcv.settings as settings
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2: peak memory is not reported
+    tracemalloc = None
+
+KERNEL_SHAPES = [(200, 200, 1024), (800, 800, 512)]
+KERNEL_DTYPES = ['float64', 'float32', 'uint16']
+KERNEL_DENSITIES = [1.0, 0.1]
+PYRAMID_SHAPES = [(200, 64), (500, 128)]
+ENCODING_SHAPES = [(20, 128), (50, 512)]
+
+
+""" REFERENCE IMPLEMENTATIONS """
+
+
+def reference_intersection_kernel(X, Y, max_num_elems=1e8):
+    n_samples_x, n_features = X.shape
+    n_samples_y, _ = Y.shape
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+
+    x_slicing = max(int(np.floor(max_num_elems / (n_samples_y * n_features))), 1)
+    intersection = np.zeros((n_samples_x, n_samples_y))
+    for i in range(0, n_samples_x, x_slicing):
+        intersection[i:i + x_slicing, :] = np.sum(np.minimum(X[i:i + x_slicing, :, None], Y[:, :, None].T), axis=1)
+    return intersection
+
+
+def reference_pyramid_kernel(X, Y):
+    # Levels from the finest one: I_0 + sum_{i>0} 2^-i (I_i - I_{i-1})
+    k = X.shape[1] // sum(num_rows * num_cols for num_rows, num_cols in settings.pyramid_levels)
+    last_index = X.shape[1]
+    intersection = None
+    previous_level_intersection = None
+    for i, (num_rows, num_cols) in enumerate(reversed(settings.pyramid_levels)):
+        first_index = last_index - k * num_rows * num_cols
+        this_level_intersection = reference_intersection_kernel(X[:, first_index:last_index],
+                                                                Y[:, first_index:last_index])
+        if i == 0:
+            intersection = this_level_intersection
+        else:
+            intersection += 2 ** -i * (this_level_intersection - previous_level_intersection)
+        previous_level_intersection = this_level_intersection
+        last_index = first_index
+    return intersection
+
+
+def reference_build_pyramid(prediction, descriptors_indices):
+    keypoints_shape = [int(v) for v in settings.get_keypoints_shape()]
+    kp_i, kp_j = keypoints_shape
+
+    v_words = []
+    for image in range(0, descriptors_indices.max() + 1):
+        image_predictions_grid = np.reshape(prediction[descriptors_indices == image], keypoints_shape)
+        im_representation = []
+        for num_rows, num_cols in settings.pyramid_levels:
+            step_i = int(math.ceil(float(kp_i) / float(num_rows)))
+            step_j = int(math.ceil(float(kp_j) / float(num_cols)))
+            for i in range(0, kp_i, step_i):
+                for j in range(0, kp_j, step_j):
+                    hist = np.bincount(image_predictions_grid[i:i + step_i, j:j + step_j].reshape(-1),
+                                       minlength=settings.codebook_size)
+                    im_representation = np.hstack((im_representation, hist))
+        v_words.append(im_representation)
+    return np.array(v_words, dtype=np.float64)
+
+
+def reference_visual_words(X, descriptors_indices, codebook, spatial_pyramid):
+    prediction = codebook.predict(X)
+    if spatial_pyramid:
+        return reference_build_pyramid(prediction, descriptors_indices)
+    return np.array([np.bincount(prediction[descriptors_indices == i], minlength=settings.codebook_size)
+                     for i in range(0, descriptors_indices.max() + 1)], dtype=np.float64)
+
+
+""" SYNTHETIC DATA """
+
+
+def random_histograms(random_state, n_samples, n_features, dtype, density):
+    counts = random_state.poisson(3, size=(n_samples, n_features))
+    counts[random_state.rand(n_samples, n_features) >= density] = 0
+    if dtype == 'uint16':
+        return counts.astype(np.uint16)
+    return (counts / np.maximum(counts.sum(axis=1, keepdims=True), 1)).astype(dtype)
+
+
+def random_descriptors(random_state, n_images, n_features=128):
+    kp_i, kp_j = [int(v) for v in settings.get_keypoints_shape()]
+    descriptors_per_image = kp_i * kp_j
+    X = random_state.rand(n_images * descriptors_per_image, n_features).astype(np.float32)
+    descriptors_indices = np.repeat(np.arange(n_images), descriptors_per_image)
+    y = np.repeat(random_state.randint(0, 8, size=n_images), descriptors_per_image)
+    return X, y, descriptors_indices
+
+
+def random_codebook(random_state, X, k):
+    codebook = cluster.MiniBatchKMeans(n_clusters=k, n_init=1, max_iter=1, batch_size=max(X.shape[0] // 10, k),
+                                       random_state=random_state)
+    return codebook.fit(X[random_state.choice(X.shape[0], min(X.shape[0], 20 * k), replace=False)])
+
+
+""" MEASUREMENTS """
+
+
+def measure(function, repeat):
+    # Best time of several runs, and peak memory of an additional traced run
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.time()
+        result = function()
+        times.append(time.time() - start)
+
+    peak_memory = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return result, min(times), peak_memory
+
+
+def same_output(result, reference, dtype):
+    if sp.issparse(result):
+        result = result.toarray()
+    rtol = 1e-4 if dtype == 'float32' else 1e-7
+    return bool(np.allclose(np.asarray(result, dtype=np.float64), reference, rtol=rtol, atol=1e-6))
+
+
+def record(results, name, params, function, reference, n_elements, unit, repeat, dtype='float64'):
+    result, seconds, peak_memory = measure(function, repeat)
+    equal = None if reference is None else same_output(result, reference(), dtype)
+    case = '{}[{}]'.format(name, ','.join('{}={}'.format(key, params[key]) for key in sorted(params)))
+    results[case] = {
+        'function': name,
+        'params': params,
+        'seconds': seconds,
+        'throughput': n_elements / seconds if seconds > 0 else None,
+        'throughput_unit': unit,
+        'peak_memory': peak_memory,
+        'equal': equal
+    }
+    io.log('{:<90} {:8.3f} s {:10.3g} {:<18} peak {:>8} equal {}'.format(
+        case, seconds, results[case]['throughput'] or 0, unit,
+        '-' if peak_memory is None else '{:.1f} MB'.format(peak_memory / 2 ** 20), equal))
+
+
+""" BENCHMARKS """
+
+
+def benchmark_kernels(results, random_state, repeat, quick):
+    shapes = KERNEL_SHAPES[:1] if quick else KERNEL_SHAPES
+    for n_x, n_y, n_features in shapes:
+        for dtype in KERNEL_DTYPES:
+            for density in KERNEL_DENSITIES:
+                X = random_histograms(random_state, n_x, n_features, dtype, density)
+                Y = random_histograms(random_state, n_y, n_features, dtype, density)
+                formats = [('dense', X, Y)]
+                if density < 1:
+                    formats.append(('csr', sp.csr_matrix(X), sp.csr_matrix(Y)))
+                for layout, X_in, Y_in in formats:
+                    for symmetric in (False, True):
+                        Y_kernel = X_in if symmetric else Y_in
+                        Y_reference = X if symmetric else Y
+                        params = {'shape': '{}x{}x{}'.format(n_x, Y_kernel.shape[0], n_features), 'dtype': dtype,
+                                  'density': density, 'format': layout, 'symmetric': symmetric}
+                        record(results, 'intersection_kernel', params,
+                               lambda: kernels.intersection_kernel(X_in, Y_kernel),
+                               lambda: reference_intersection_kernel(X, Y_reference),
+                               n_x * Y_kernel.shape[0] * n_features, 'kernel terms/s', repeat, dtype)
+
+
+def benchmark_pyramid_kernel(results, random_state, repeat, quick):
+    shapes = PYRAMID_SHAPES[:1] if quick else PYRAMID_SHAPES
+    n_cells = sum(num_rows * num_cols for num_rows, num_cols in settings.pyramid_levels)
+    for n_samples, k in shapes:
+        for dtype in KERNEL_DTYPES:
+            X = random_histograms(random_state, n_samples, n_cells * k, dtype, 0.2)
+            params = {'shape': '{}x{}x{}'.format(n_samples, n_samples, n_cells * k), 'dtype': dtype}
+            record(results, 'pyramid_kernel', params, lambda: kernels.pyramid_kernel(X),
+                   lambda: reference_pyramid_kernel(X, X), n_samples * n_samples * n_cells * k, 'kernel terms/s',
+                   repeat, dtype)
+
+
+def benchmark_encodings(results, random_state, repeat, quick):
+    shapes = ENCODING_SHAPES[:1] if quick else ENCODING_SHAPES
+    codebook_size = settings.codebook_size
+    try:
+        for n_images, k in shapes:
+            settings.codebook_size = k
+            X, y, descriptors_indices = random_descriptors(random_state, n_images)
+            codebook = random_codebook(random_state, X, k)
+            prediction = codebook.predict(X)
+
+            for spatial_pyramid in (False, True):
+                for sparse in (False, True):
+                    params = {'images': n_images, 'k': k, 'spatial_pyramid': spatial_pyramid, 'sparse': sparse}
+                    record(results, 'visual_words', params,
+                           lambda: bovw.visual_words(X, y, descriptors_indices, codebook,
+                                                     spatial_pyramid=spatial_pyramid, cache_assignments=False,
+                                                     sparse=sparse)[0],
+                           lambda: reference_visual_words(X, descriptors_indices, codebook, spatial_pyramid),
+                           X.shape[0], 'descriptors/s', repeat)
+
+            for sparse in (False, True):
+                params = {'images': n_images, 'k': k, 'sparse': sparse}
+                record(results, 'build_pyramid', params,
+                       lambda: bovw.build_pyramid(prediction, descriptors_indices, sparse=sparse),
+                       lambda: reference_build_pyramid(prediction, descriptors_indices),
+                       X.shape[0], 'descriptors/s', repeat)
+
+            benchmark_fisher_vectors(results, X, y, descriptors_indices, n_images, k, repeat)
+    finally:
+        settings.codebook_size = codebook_size
+
+
+def benchmark_fisher_vectors(results, X, y, descriptors_indices, n_images, k, repeat):
+    try:
+        from libraries.yael.yael import ynumpy
+    except ImportError:
+        io.log('fisher_vectors[images={},k={}] skipped: yael is not available'.format(n_images, k))
+        return
+
+    gmm = ynumpy.gmm_learn(X[::10], k)
+
+    def reference():
+        return np.array([ynumpy.fisher(gmm, X[descriptors_indices == i], include=['mu', 'sigma'])
+                         for i in range(0, descriptors_indices.max() + 1)])
+
+    record(results, 'fisher_vectors', {'images': n_images, 'k': k},
+           lambda: bovw.fisher_vectors(X, y, descriptors_indices, gmm)[0], reference, X.shape[0], 'descriptors/s',
+           repeat, 'float32')
+
+
+""" BASELINE COMPARISON """
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    regressions = []
+    for case, result in sorted(results.items()):
+        if result['equal'] is False:
+            regressions.append('{}: output differs from the reference'.format(case))
+        previous = baseline.get(case)
+        if previous is None:
+            continue
+        if result['seconds'] > previous['seconds'] * (1 + tolerance):
+            regressions.append('{}: {:.3f} s, baseline {:.3f} s ({:+.0%})'.format(
+                case, result['seconds'], previous['seconds'], result['seconds'] / previous['seconds'] - 1))
+        if result['peak_memory'] is not None and previous.get('peak_memory') and \
+                result['peak_memory'] > previous['peak_memory'] * (1 + tolerance):
+            regressions.append('{}: peak memory {:.1f} MB, baseline {:.1f} MB'.format(
+                case, result['peak_memory'] / 2 ** 20, previous['peak_memory'] / 2 ** 20))
+    return regressions
+
+
+if __name__ == '__main__':
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument('--output', help='JSON file where the results are written')
+    args_parser.add_argument('--baseline', help='JSON file with the results of a previous run to compare with')
+    args_parser.add_argument('--tolerance', type=float, default=0.2,
+                             help='Relative slowdown (or memory increase) reported as a regression')
+    args_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs of each case')
+    args_parser.add_argument('--n-jobs', type=int, default=settings.n_jobs, help='Threads used by the kernels')
+    args_parser.add_argument('--quick', action='store_true', help='Only run the smallest shapes')
+    args_parser.add_argument('--only', nargs='+', default=['kernels', 'pyramid', 'encodings'],
+                             choices=['kernels', 'pyramid', 'encodings'])
+    args = args_parser.parse_args()
+
+    settings.n_jobs = args.n_jobs
+    random_state = np.random.RandomState(42)
+    results = {}
+
+    if 'kernels' in args.only:
+        benchmark_kernels(results, random_state, args.repeat, args.quick)
+    if 'pyramid' in args.only:
+        benchmark_pyramid_kernel(results, random_state, args.repeat, args.quick)
+    if 'encodings' in args.only:
+        benchmark_encodings(results, random_state, args.repeat, args.quick)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                                'machine': platform.machine(), 'n_jobs': settings.n_jobs},
+                'results': results
+            }, f, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            io.log('REGRESSION {}'.format(regression), out='stderr')
+        io.log('{} regressions out of {} cases (tolerance {:.0%})'.format(len(regressions), len(results),
+                                                                         args.tolerance))
+        sys.exit(1 if regressions else 0)
@@ -17,16 +17,10 @@ from mlcv.plotting import plot_confusion_matrix
 N_JOBS = 6
 
 
-def parallel_testing(test_image, test_label, lin_svm, std_scaler, pca):
-    probs = [0,0,0,0,0,0,0,0]
+def compute_descriptors(test_image):
     gray = io.load_grayscale_image(test_image)
     kpt, des = feature_extraction.sift(gray)
-    predictions = classification.predict_svm(des, lin_svm, std_scaler=std_scaler, pca=pca, probability=True)
-    for j in range(0, len(predictions)):
-        probs = probs + predictions[j]
-    predicted_class = lin_svm.classes_[np.argmax(probs)]
-
-    return predicted_class == test_label, predicted_class, test_label
+    return des
 
 
 """ MAIN SCRIPT"""
@@ -54,15 +48,18 @@ if __name__ == '__main__':
     test_images_filenames, test_labels = io.load_test_set()
     print('Loaded {} test images.'.format(len(test_images_filenames)))
 
-    # Feature extraction with sift, prediction with SVM and aggregation to obtain final class
+    # Feature extraction with sift
     print('Predicting test data...')
-    result = joblib.Parallel(n_jobs=N_JOBS, backend='threading')(
-        joblib.delayed(parallel_testing)(test_image, test_label, lin_svm, std_scaler, pca) for test_image, test_label in
-        zip(test_images_filenames, test_labels))
-
-    correct_class = [i[0] for i in result]
-    predicted = [i[1] for i in result]
-    expected = [i[2] for i in result]
+    descriptors = joblib.Parallel(n_jobs=N_JOBS, backend='threading')(
+        joblib.delayed(compute_descriptors)(test_image) for test_image in test_images_filenames)
+
+    # Prediction with SVM of all the descriptors at once, and aggregation per image to obtain final class
+    offsets = np.cumsum([0] + [des.shape[0] for des in descriptors[:-1]])
+    probs = classification.predict_svm_batch(np.vstack(descriptors), offsets, lin_svm, std_scaler=std_scaler,
+                                             pca=pca, probability=True, n_jobs=N_JOBS)
+    predicted = lin_svm.classes_[np.argmax(probs, axis=1)]
+    expected = np.asarray(test_labels)
+    correct_class = predicted == expected
 
     num_correct = np.count_nonzero(correct_class)
     print('Time spend: {:.2f} s'.format(time.time() - temp))
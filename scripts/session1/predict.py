@@ -13,14 +13,10 @@ from mlcv.plotting import plot_confusion_matrix
 from scripts import SESSION1
 
 
-def parallel_testing(test_image, test_label, svm, std_scaler, pca):
+def compute_descriptors(test_image):
     gray = io.load_grayscale_image(test_image)
     kpt, des = feature_extraction.sift(gray)
-    predictions = classification.predict_svm(des, svm, std_scaler=std_scaler, pca=pca, probability=True)
-    probabilities = np.sum(predictions, axis=0)
-    predicted_class = svm.classes_[np.argmax(probabilities)]
-
-    return predicted_class == test_label, predicted_class, test_label
+    return des
 
 
 if __name__ == '__main__':
@@ -35,21 +31,18 @@ if __name__ == '__main__':
     std_scaler = io.load_object(SESSION1['scaler'])
     pca = io.load_object(SESSION1['pca'])
 
-    # Feature extraction with sift, prediction with SVM and aggregation to obtain final class
+    # Feature extraction with sift
     print('Predicting test data...')
-    result = joblib.Parallel(n_jobs=SESSION1['n_jobs'], backend='threading')(
-        joblib.delayed(parallel_testing)(
-            test_image,
-            test_label,
-            svm,
-            std_scaler,
-            pca
-        ) for test_image, test_label in
-        zip(test_images_filenames, test_labels))
-
-    correct_class = [i[0] for i in result]
-    predicted = [i[1] for i in result]
-    expected = [i[2] for i in result]
+    descriptors = joblib.Parallel(n_jobs=SESSION1['n_jobs'], backend='threading')(
+        joblib.delayed(compute_descriptors)(test_image) for test_image in test_images_filenames)
+
+    # Prediction with SVM of all the descriptors at once, and aggregation per image to obtain final class
+    offsets = np.cumsum([0] + [des.shape[0] for des in descriptors[:-1]])
+    probabilities = classification.predict_svm_batch(np.vstack(descriptors), offsets, svm, std_scaler=std_scaler,
+                                                     pca=pca, probability=True, n_jobs=SESSION1['n_jobs'])
+    predicted = svm.classes_[np.argmax(probabilities, axis=1)]
+    expected = np.asarray(test_labels)
+    correct_class = predicted == expected
 
     num_correct = np.count_nonzero(correct_class)
     print('Time spend: {:.2f} s'.format(time.time() - start))
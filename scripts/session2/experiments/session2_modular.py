@@ -21,7 +21,7 @@ def seq_testing(test_image, test_label, codebook, svm, scaler, pca):
     kpt, des = feature_extraction.sift(gray)
     labels = np.array([test_label] * des.shape[0])
     ind = np.array([0] * des.shape[0])
-    vis_word, _ = bovw.visual_words(des, labels, ind, codebook)
+    vis_word, _ = bovw.visual_words(des, labels, ind, codebook, cache_assignments=False)
     prediction_prob = classification.predict_svm(vis_word, svm, std_scaler=scaler, pca=pca)
     predicted_class = lin_svm.classes_[np.argmax(prediction_prob)]
     return predicted_class == test_label, predicted_class, np.ravel(prediction_prob)
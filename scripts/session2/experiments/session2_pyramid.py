@@ -20,7 +20,7 @@ def parallel_testing(test_image, test_label, codebook, svm, scaler, pca):
     kpt_pos = np.array([kpt[i].pt for i in range(0, len(kpt))], dtype=np.float64)
     labels = np.array([test_label] * des.shape[0])
     ind = np.array([0] * des.shape[0])
-    vis_word, _ = bovw.visual_words(des, labels, ind, codebook, spatial_pyramid=True)
+    vis_word, _ = bovw.visual_words(des, labels, ind, codebook, spatial_pyramid=True, cache_assignments=False)
     prediction_prob = classification.predict_svm(vis_word, svm, std_scaler=scaler, pca=pca)
     predicted_class = svm.classes_[np.argmax(prediction_prob)]
     return predicted_class == test_label, predicted_class, np.ravel(prediction_prob)
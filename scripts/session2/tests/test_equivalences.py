@@ -0,0 +1,86 @@
+from __future__ import print_function, division
+
+import shutil
+
+import numpy as np
+from sklearn import svm
+
+from mlcv import classification
+from mlcv import export
+
+""" SYNTHETIC DATA """
+
+# Non-negative histograms of 3 classes, each with more mass in its own block of bins
+rng = np.random.RandomState(0)
+n_samples, n_features, n_classes = 150, 24, 3
+y_train = rng.randint(0, n_classes, n_samples)
+X_train = rng.poisson(2, (n_samples, n_features)).astype(np.float64)
+for c in range(n_classes):
+    X_train[y_train == c, c * 8:(c + 1) * 8] += rng.poisson(2, (np.sum(y_train == c), 8))
+X_test = rng.poisson(3, (50, n_features)).astype(np.float64)
+
+
+def check(name, expected, computed, expected_labels, computed_labels):
+    print('{}: max difference {:.2e}, equal scores: {}, equal labels: {}'.format(
+        name, np.max(np.abs(expected - computed)), np.allclose(expected, computed),
+        np.array_equal(expected_labels, computed_labels)))
+
+
+""" EXPORTED PREDICTOR EQUALS predict_svm """
+
+binary = y_train < 2
+models = [
+    ('rbf with PCA and scaler', classification.train_rbf_svm(X_train, y_train, gamma=0.05, dim_reduction=10,
+                                                            probability='decision')),
+    ('linear with PCA and scaler', classification.train_linear_svm(X_train, y_train, dim_reduction=10,
+                                                                  solver='libsvm', probability='decision')),
+    ('liblinear with PCA and scaler', classification.train_linear_svm(X_train, y_train, dim_reduction=10,
+                                                                     solver='liblinear_primal',
+                                                                     probability='decision')),
+    ('precomputed intersection', classification.train_intersection_svm(X_train, y_train, standardize=False,
+                                                                      precomputed=True, probability='decision')),
+    ('binary precomputed intersection', classification.train_intersection_svm(
+        X_train[binary], y_train[binary], standardize=False, precomputed=True, probability='decision'))
+]
+for name, (clf, std_scaler, pca) in models:
+    export.export_pipeline('test_equivalences', clf, pca=pca, std_scaler=std_scaler)
+    exported = export.ExportedPipeline('test_equivalences')
+    check('Exported {}'.format(name),
+          classification.predict_svm(X_test, clf, std_scaler=std_scaler, pca=pca), exported.decision_function(X_test),
+          classification.predict_svm(X_test, clf, std_scaler=std_scaler, pca=pca, probability=False),
+          exported.predict(X_test))
+
+""" PARALLEL SVC EQUALS SVC """
+
+for kernel in ('rbf', 'intersection'):
+    reference = svm.SVC(C=1, kernel=classification.KERNELS.get(kernel, kernel), gamma=0.05,
+                        decision_function_shape='ovr').fit(X_train, y_train)
+    parallel = classification.ParallelSVC(C=1, kernel=kernel, gamma=0.05, n_jobs=2).fit(X_train, y_train)
+    check('ParallelSVC with {} kernel'.format(kernel),
+          reference.decision_function(X_test), parallel.decision_function(X_test),
+          reference.predict(X_test), parallel.predict(X_test))
+
+""" FAST INTERSECTION SVM PREDICTOR EQUALS decision_function """
+
+for name, (clf, _, _) in models[3:]:
+    predictor = classification.IntersectionSVMPredictor(clf)
+    expected = classification.predict_svm(X_test, clf)
+    check('IntersectionSVMPredictor, {}'.format(name), expected, classification.predict_svm(X_test, predictor),
+          classification.predict_svm(X_test, clf, probability=False), predictor.predict(X_test))
+
+""" FOLDED LINEAR MODEL EQUALS THE UNFOLDED ONE, ALSO EXPORTED """
+
+for name, (clf, std_scaler, pca) in models[1:3]:
+    folded = classification.fold_linear_model(clf, std_scaler=std_scaler, pca=pca)
+    expected = classification.predict_svm(X_test, clf, std_scaler=std_scaler, pca=pca)
+    expected_labels = classification.predict_svm(X_test, clf, std_scaler=std_scaler, pca=pca, probability=False)
+    # The unfolded pipeline rounds the PCA output to float32, hence the small differences
+    check('Folded {}'.format(name), expected, classification.predict_svm(X_test, folded), expected_labels,
+          folded.predict(X_test))
+
+    export.export_pipeline('test_equivalences', folded)
+    exported = export.ExportedPipeline('test_equivalences')
+    check('Exported folded {}'.format(name), classification.predict_svm(X_test, folded),
+          exported.decision_function(X_test), folded.predict(X_test), exported.predict(X_test))
+
+shutil.rmtree(export.export_path('test_equivalences'))
@@ -6,6 +6,22 @@ import numpy as np
 
 from mlcv.kernels import intersection_kernel
 
+
+def reference_intersection_kernel(X, Y, max_num_elems=1e8):
+    """ Previous implementation of the intersection kernel, used to check the results and the speedup """
+    n_samples_x, n_features = X.shape
+    n_samples_y, _ = Y.shape
+
+    if n_samples_x * n_samples_y * n_features < max_num_elems:
+        return np.sum(np.minimum(X[:, :, None], Y[:, :, None].T), axis=1)
+
+    x_slicing = int(np.floor(max_num_elems / (n_samples_y * n_features)))
+    intersection = np.zeros((n_samples_x, n_samples_y))
+    for i in range(0, n_samples_x, x_slicing):
+        intersection[i:i + x_slicing, :] = np.sum(np.minimum(X[i:i + x_slicing, :, None], Y[:, :, None].T), axis=1)
+    return intersection
+
+
 """ TEST CORRECTENESS """
 
 # Array X
@@ -42,18 +58,22 @@ print('Computed result array:\n {}'.format(result))
 
 """ TEST EFFICIENCY """
 
-# Computationally efficient version
-X = np.random.randn(1500, 64)
-Y = np.random.randn(1500, 64)
 
-start = time.time()
-gram = intersection_kernel(X, Y)
-print('Elapsed time for {} x {} arrays: {:.2f}'.format(X.shape[0], X.shape[1], time.time() - start))
+def compare(X, Y):
+    start = time.time()
+    gram = intersection_kernel(X, Y)
+    elapsed = time.time() - start
+
+    start = time.time()
+    gram_ref = reference_intersection_kernel(X, Y)
+    elapsed_ref = time.time() - start
+
+    print('Elapsed time for {} x {} arrays: {:.2f} s (reference: {:.2f} s, speedup: {:.1f}x), equal results: {}'.format(
+        X.shape[0], X.shape[1], elapsed, elapsed_ref, elapsed_ref / elapsed, np.allclose(gram, gram_ref)))
+
 
-# Memory efficient version
-X = np.random.randn(1500, 2**12)
-Y = np.random.randn(1500, 2**12)
+# Small arrays (the reference implementation materializes the whole tensor)
+compare(np.random.randn(1500, 64), np.random.randn(1500, 64))
 
-start = time.time()
-gram_2 = intersection_kernel(X, Y)
-print('Elapsed time for {} x {} arrays: {:.2f}'.format(X.shape[0], X.shape[1], time.time() - start))
+# Large arrays (the reference implementation slices only along X)
+compare(np.random.randn(1500, 2 ** 12), np.random.randn(1500, 2 ** 12))
@@ -22,7 +22,7 @@ def parallel_testing(test_image, test_label, svm, scaler):
     ind = np.array([0] * des.shape[0])
 
     pca, des = feature_extraction.pca(des)
-    pyramid, _ = bovw.visual_words(des, labels, ind, codebook, spatial_pyramid=True)
+    pyramid, _ = bovw.visual_words(des, labels, ind, codebook, spatial_pyramid=True, cache_assignments=False)
 
     prediction_prob = classification.predict_svm(pyramid, svm, std_scaler=scaler)
     predicted_class = svm.classes_[np.argmax(prediction_prob)]